@@ -0,0 +1,339 @@
+"""Headless benchmark of the Laser Graffiti game loop.
+
+Runs the real game loop on a recorded clip (see Graffiti.py --record) or on
+a synthetic one, without any window, and prints per stage latencies as JSON.
+
+Example usage:
+$ python Benchmark.py --replay=session.clip --out=bench.json
+"""
+
+
+import cv2
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+from threading import current_thread
+from typing import Dict, List, Tuple
+from CamUtils import ReplayVideoStream
+from ClipFile import ClipWriter
+from Graffiti import (
+    GraffitiState,
+    create_state,
+    game_loop,
+    detector_options_from_args,
+    start_detector_pools,
+)
+from MarkerDetector import DETECTORS, DEFAULT_DETECTOR, PYRAMID_SCALE, create_detector
+from ScreenUtils import NullDisplay, set_display, calibration_key, load_calibration
+from Metrics import gMetrics
+from Shapes import Point
+
+
+parser = argparse.ArgumentParser(description="Laser Graffiti benchmark")
+
+parser.add_argument(
+    "--replay",
+    default=None,
+    type=str,
+    help="Clip file to run on (a synthetic clip is used if not given)",
+)
+
+parser.add_argument(
+    "--synthetic_frames",
+    default=300,
+    type=int,
+    help="Number of frames in the synthetic clip",
+)
+
+parser.add_argument(
+    "--frame_size",
+    default="1280x720",
+    type=str,
+    help="WxH of the synthetic clip's frames",
+)
+
+parser.add_argument(
+    "--screen_size",
+    default="1920x1080",
+    type=str,
+    help="WxH of the (pretend) screen",
+)
+
+parser.add_argument(
+    "--realtime",
+    action="store_true",
+    help="Replay with the clip's original timing instead of as fast as possible",
+)
+
+parser.add_argument(
+    "--detector",
+    default=DEFAULT_DETECTOR,
+    choices=sorted(DETECTORS),
+    help="Marker detection algorithm",
+)
+
+parser.add_argument(
+    "--pyramid_scale",
+    default=PYRAMID_SCALE,
+    type=int,
+    choices=[2, 4],
+    help="Downscale factor for the coarse search of the pyramid detector",
+)
+
+parser.add_argument(
+    "--roi_tracking",
+    action="store_true",
+    help="Only search for the marker around its last known position",
+)
+
+parser.add_argument(
+    "--static_hold_sec",
+    default=None,
+    type=float,
+    help="Ignore red spots that stay lit for longer than this (e.g. signs or glare)",
+)
+
+parser.add_argument(
+    "--static_spot",
+    action="store_true",
+    help="Add a static red spot (like an exit sign) to the synthetic clip",
+)
+
+parser.add_argument(
+    "--suppress_display",
+    action="store_true",
+    help="Don't mistake red things we show on screen for the laser",
+)
+
+parser.add_argument(
+    "--pointers",
+    default=1,
+    type=int,
+    help="Track up to this many pointers at once",
+)
+
+parser.add_argument(
+    "--synthetic_pointers",
+    default=1,
+    type=int,
+    help="Number of laser dots moving around in the synthetic clip",
+)
+
+parser.add_argument(
+    "--predict",
+    action="store_true",
+    help="Smooth the marker's motion, and show where it is predicted to be now",
+)
+
+parser.add_argument(
+    "--cold_start",
+    action="store_true",
+    help="Only start the detection workers once the game loop starts, rather "
+    "than before opening the clip (to compare startup times)",
+)
+
+parser.add_argument(
+    "--out",
+    default=None,
+    type=str,
+    help="Write the JSON report to this file instead of stdout",
+)
+
+SYNTHETIC_FPS = 30
+SYNTHETIC_DOT_RADIUS = 4
+# How far (in canvas pixels) a detection may be from a dot to count as it
+DOT_MATCH_DIST = 20
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    w, h = size.lower().split("x")
+    return int(w), int(h)
+
+
+def write_synthetic_clip(
+    path: str,
+    frame_cnt: int,
+    frame_size: Tuple[int, int],
+    static_spot: bool = False,
+    dot_cnt: int = 1,
+):
+    """A dim, noisy frame with laser dots moving around in it."""
+    w, h = frame_size
+    rng = np.random.default_rng(0)
+    # Grey noise, so that only the dot has any colour
+    background = cv2.cvtColor(
+        rng.integers(30, 70, (h, w), dtype=np.uint8), cv2.COLOR_GRAY2BGR
+    )
+    if static_spot:
+        # Out of the dot's way, in the top left corner
+        cv2.rectangle(
+            background, (w // 40, h // 40), (w // 8, h // 10), (60, 60, 230), -1
+        )
+    writer = ClipWriter(path)
+    for i in range(frame_cnt):
+        frame = background.copy()
+        t = i / SYNTHETIC_FPS
+        for dot in range(dot_cnt):
+            # Same path for every dot, each one further along it
+            phase = dot * 2 * np.pi / dot_cnt
+            x = int(w / 2 + w / 3 * np.sin(t * 1.3 + phase))
+            y = int(h / 2 + h / 3 * np.sin(t * 2.1 + phase))
+            draw_dot(frame, x, y)
+        writer.append(frame, t)
+    writer.close()
+
+
+def draw_dot(frame, x: int, y: int):
+    cv2.circle(frame, (x, y), SYNTHETIC_DOT_RADIUS, (80, 80, 255), cv2.FILLED)
+    cv2.circle(frame, (x, y), SYNTHETIC_DOT_RADIUS // 2, (230, 230, 255), -1)
+
+
+def undetectable_buttons(args, state: GraffitiState, frame) -> List[int]:
+    """The (indices of the) buttons where a laser dot in the middle is not
+    found, e.g. because the display mask covers them."""
+    detector = create_detector(args.detector, **detector_options_from_args(args))
+    mask = (
+        state.display_mask.update(state.canvas, state.widgets)
+        if state.display_mask
+        else None
+    )
+    missed = []
+    for i, button in enumerate(state.widgets.widgets):
+        r = button.position
+        center = Point((r.left_x() + r.right_x()) // 2, (r.bottom_y() + r.top_y()) // 2)
+        img = frame.copy()
+        x, y = state.canvas_mapping.to_frame(center)
+        draw_dot(img, int(round(x)), int(round(y)))
+        candidates = detector.find_marker_candidates(
+            img, state.canvas_mapping, None, time.perf_counter(), mask
+        )
+        dists = np.linalg.norm(candidates - center.as_tuple(), axis=1)
+        if not (dists < DOT_MATCH_DIST).any():
+            missed.append(i)
+    return missed
+
+
+def run_benchmark(args, clip_path: str) -> Dict:
+    launch_time = time.perf_counter()
+    pools = (
+        None
+        if args.cold_start
+        else start_detector_pools(1, args.detector, detector_options_from_args(args))
+    )
+    screen_size = parse_size(args.screen_size)
+    set_display(NullDisplay(), screen_size)
+
+    cam = ReplayVideoStream(clip_path, realtime=args.realtime).start()
+    try:
+        img = cam.read()
+        h, w = img.shape[:2]
+        # Use the clip's saved calibration if there is one, otherwise pretend
+        # the screen fills the whole frame
+        saved_quad = load_calibration(calibration_key(cam, img))
+        screen_quad = (
+            saved_quad
+            if saved_quad is not None
+            else np.array([[0, 0], [w, 0], [w, h], [0, h]], np.float32)
+        )
+
+        state = create_state(
+            cam,
+            screen_quad,
+            screen_size,
+            args.roi_tracking,
+            predict=args.predict,
+            suppress_display=args.suppress_display,
+            max_pointers=args.pointers,
+        )
+
+        gMetrics.reset()
+        start = time.perf_counter()
+        game_loop(
+            cam,
+            state,
+            mirror=False,
+            enable_perf_prints=False,
+            detector_name=args.detector,
+            detector_options=detector_options_from_args(args),
+            pools=pools,
+            launch_time=launch_time,
+        )
+        elapsed = time.perf_counter() - start
+        # With what was drawn by now (and so the display mask) the buttons
+        # must still work
+        missed_buttons = undetectable_buttons(args, state, img)
+    finally:
+        for pool in pools or []:
+            pool.terminate()
+        cam.stop()
+
+    # Drawing and display run on this thread, detection and the camera stages
+    # on their own
+    metrics = gMetrics.snapshot()
+    stages = metrics.get(current_thread().name, {})
+    detection_stages = metrics.get("Detection", {})
+    ticks = stages.get("Tracking", {}).get("count", 0)
+    detection_ticks = detection_stages.get("Marker finding", {}).get("count", 0)
+    frames = cam.seq + 1
+    # Measured from when run_benchmark started, like from launch in the game
+    first_stroke = stages.get("Time to first stroke", {})
+    first_stroke_sec = (
+        first_stroke["max_ms"] / 1000 if first_stroke.get("count") else None
+    )
+    return {
+        "clip": args.replay or "synthetic",
+        "frame_size": [w, h],
+        "screen_size": list(screen_size),
+        "detector": args.detector,
+        "roi_tracking": args.roi_tracking,
+        "static_hold_sec": args.static_hold_sec,
+        "predict": args.predict,
+        "suppress_display": args.suppress_display,
+        "pointers": args.pointers,
+        "realtime": args.realtime,
+        "cold_start": args.cold_start,
+        "first_stroke_sec": first_stroke_sec,
+        "elapsed_sec": elapsed,
+        "ticks": ticks,
+        "frames": frames,
+        "ticks_per_sec": ticks / elapsed,
+        "detection_ticks": detection_ticks,
+        "frames_per_sec": frames / elapsed,
+        "canvas_tiles": len(state.canvas.tiles),
+        "canvas_mb": state.canvas.nbytes() / 2**20,
+        "undetectable_buttons": missed_buttons,
+        "stages": stages,
+        "detection_stages": detection_stages,
+        "camera_stages": metrics.get(cam.thread_name, {}),
+    }
+
+
+def main():
+    args = parser.parse_args()
+
+    if args.replay:
+        report = run_benchmark(args, args.replay)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            clip_path = f"{tmp_dir}/synthetic.clip"
+            write_synthetic_clip(
+                clip_path,
+                args.synthetic_frames,
+                parse_size(args.frame_size),
+                args.static_spot,
+                args.synthetic_pointers,
+            )
+            report = run_benchmark(args, clip_path)
+
+    report_json = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+
+if __name__ == "__main__":
+    main()
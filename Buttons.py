@@ -1,5 +1,7 @@
 import cv2
-from typing import Callable, Optional
+import os
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
 from Shapes import Point, Rectangle
 from Colors import WHITE
 import numpy as np
@@ -7,6 +9,29 @@ import numpy as np
 
 IMG_FILL_FACTOR = 0.5
 BORDER_WITH = 3
+ICONS_DIR = "Icons"
+
+
+@lru_cache(maxsize=None)
+def read_icon(image_path: str):
+    """The icon as decoded from disk, read once. The result is shared and
+    read only."""
+    pic = cv2.imread(image_path)
+    pic.setflags(write=False)
+    return pic
+
+
+def preload_icons():
+    """Reads every icon ahead of time. The button sizes aren't known until
+    the screen is calibrated, so only the (slow) decoding can be done early."""
+    for name in os.listdir(ICONS_DIR):
+        # Spelled the way the buttons name them, so the cache hits
+        read_icon(f"{ICONS_DIR}/{name}")
+
+
+def load_icon(image_path: str, size: Tuple[int, int]):
+    """The icon, resized to (w, h)."""
+    return cv2.resize(read_icon(image_path), size, interpolation=cv2.INTER_AREA)
 
 
 class Button:
@@ -19,21 +44,24 @@ class Button:
         position: Rectangle,
         image_path: str,
         frame_color=WHITE,
+        repeat: bool = True,
     ):
         self.callback = callback
         self.position = position
+        # Buttons that don't repeat only fire again after being released
+        self.repeat = repeat
+        self.held = False
         # Black background
         self.img = np.zeros(
             (self.position.width(), self.position.height(), 3),
             np.uint8,
         )
-        pic = cv2.resize(
-            cv2.imread(image_path),
+        pic = load_icon(
+            image_path,
             (
                 int(self.position.width() * IMG_FILL_FACTOR),
                 int(self.position.height() * IMG_FILL_FACTOR),
             ),
-            interpolation=cv2.INTER_AREA,
         )
         full_margin_x = self.position.width() - int(
             self.position.width() * IMG_FILL_FACTOR
@@ -84,23 +112,23 @@ class Button:
             lineType=cv2.LINE_AA,
         )
 
+        # Shown while pressed
+        self.hover_img = np.zeros(self.img.shape, np.uint8)
+
     def is_pressed(self, marker_pos: Optional[Point]):
         return self.position.contains(marker_pos)
 
     def do_callback(self):
         self.callback()
 
-    def draw(self, canvas, marker_pos: Optional[Point]):
-        if marker_pos and self.is_pressed(marker_pos):
-            canvas[
-                self.position.bottom_y() : self.position.top_y(),
-                self.position.left_x() : self.position.right_x(),
-            ] = np.zeros(
-                self.img.shape,
-                np.uint8,
-            )
-        else:
-            canvas[
-                self.position.bottom_y() : self.position.top_y(),
-                self.position.left_x() : self.position.right_x(),
-            ] = self.img
+    def press(self, pressed: bool) -> bool:
+        """Called every tick, fires the callback if pressed (and allowed to
+        repeat). Returns whether it fired."""
+        fire = pressed and (self.repeat or not self.held)
+        self.held = pressed
+        if fire:
+            self.do_callback()
+        return fire
+
+    def sprite(self):
+        return self.hover_img if self.held else self.img
@@ -1,16 +1,65 @@
 import cv2
-from typing import Optional
-from threading import Thread, Lock
+import time
+import numpy as np
+from typing import Optional, List, Union
+from threading import Thread, Condition
 from Shapes import Rectangle
 from FPSMonitor import FPSMonitor
+from Timestamper import Timestamper
+from ClipFile import ClipWriter, ClipReader
+from MjpegStream import MjpegStream, is_mjpeg_url
+
+
+# Consumers must be done with a frame before this many newer frames arrive
+FRAME_RING_SIZE = 8
 
 
 def get_cam(
     video_url: Optional[str] = None,
     camera_id: Optional[int] = None,
-    enable_perf_prints: bool = False,
+    record_path: Optional[str] = None,
+    replay_path: Optional[str] = None,
+    replay_realtime: bool = True,
+    decode_scale: int = 1,
 ):
-    return WebcamVideoStream(video_url, camera_id, enable_perf_prints).start()
+    if replay_path:
+        return ReplayVideoStream(replay_path, replay_realtime).start()
+
+    return WebcamVideoStream(
+        video_url, camera_id, record_path=record_path, decode_scale=decode_scale
+    ).start()
+
+
+def crop_frame(frame, crop_rect: Optional[Rectangle]):
+    if not crop_rect:
+        return frame
+    return frame[
+        crop_rect.bottom_y() : crop_rect.top_y(),
+        crop_rect.left_x() : crop_rect.right_x(),
+        :,
+    ]
+
+
+def open_stream(
+    video_url: Optional[str], camera_id: Optional[int], decode_scale: int = 1
+) -> Union[MjpegStream, cv2.VideoCapture]:
+    if video_url and is_mjpeg_url(video_url):
+        try:
+            return MjpegStream(video_url, decode_scale)
+        except ValueError:
+            # Some other kind of stream, leave it to OpenCV
+            pass
+    if video_url:
+        return cv2.VideoCapture(video_url)
+    return cv2.VideoCapture(camera_id or 0)
+
+
+class CamFrame:
+    def __init__(self, seq: int, timestamp: float, img):
+        self.seq = seq
+        # time.perf_counter() of when the frame was captured
+        self.timestamp = timestamp
+        self.img = img
 
 
 # Based on https://gist.github.com/allskyee/7749b9318e914ca45eb0a1000a81bf56
@@ -19,18 +68,49 @@ class WebcamVideoStream:
         self,
         video_url: Optional[str],
         camera_id: Optional[int],
-        enable_perf_prints: bool,
+        ring_size: int = FRAME_RING_SIZE,
+        record_path: Optional[str] = None,
+        decode_scale: int = 1,
     ):
-        self.stream = cv2.VideoCapture(video_url or camera_id)
+        # Identifies this camera, e.g. for saving its calibration
+        self.source = str(video_url or camera_id)
+        self.stream: Union[MjpegStream, cv2.VideoCapture] = open_stream(
+            video_url, camera_id, decode_scale
+        )
+        if isinstance(self.stream, MjpegStream) and decode_scale > 1:
+            # Calibration done at another resolution doesn't fit
+            self.source += f" (1/{decode_scale})"
+        # Metrics are kept per thread name, so every camera needs its own
+        self.thread_name = f"Camera {self.source}"
 
-        _, self.frame = self.stream.read()
         self.running = False
         self.thread = None
         self.crop_rect: Optional[Rectangle] = None
-        self.lock = Lock()
-        self.fps_monitor = FPSMonitor(
-            "Camera fps monitor", printing_enabled=enable_perf_prints
-        )
+        self.cond = Condition()
+        self.fps_monitor = FPSMonitor("Camera fps")
+
+        # Frames are cropped straight into a ring of preallocated buffers
+        self.ring_size = ring_size
+        self.ring: List = []
+        self.timestamps = [0.0] * ring_size
+        # seq of the newest frame in the ring, and of the oldest one that still
+        # has the current crop size
+        self.seq = -1
+        self.first_seq = 0
+
+        # Everything we store in the ring is also appended to the clip file
+        self.recorder = ClipWriter(record_path) if record_path else None
+
+        _, raw_frame = self.stream.read()
+        self.raw_frame: Optional[np.ndarray] = raw_frame
+        self.store_frame(self.raw_frame, time.perf_counter())
+
+    def read_frame(self):
+        if isinstance(self.stream, MjpegStream):
+            # Every frame is decoded into a new image anyway
+            return self.stream.read()
+        # Reuse the last frame's buffer
+        return self.stream.read(self.raw_frame)
 
     def update_crop_rect(self, crop_rect: Rectangle):
         self.crop_rect = crop_rect
@@ -40,34 +120,204 @@ class WebcamVideoStream:
             # This can only be started once
             return None
         self.running = True
-        self.thread = Thread(target=self.update, args=())
+        self.thread = Thread(target=self.update, args=(), name=self.thread_name)
         self.thread.start()
         return self
 
     def update(self):
+        timestamper = Timestamper()
         while self.running:
             self.fps_monitor.tick()
-            _, frame = self.stream.read()
-            crop_rect = self.crop_rect
-            if crop_rect:
-                frame = frame[
-                    crop_rect.bottom_y() : crop_rect.top_y(),
-                    crop_rect.left_x() : crop_rect.right_x(),
-                    :,
-                ]
-
-            frame_copy = frame.copy()
-            with self.lock:
-                self.frame = frame_copy
+            timestamper.stamp_start("Capture")
+            ok, frame = self.read_frame()
+            timestamp = time.perf_counter()
+            if not ok:
+                continue
+            self.raw_frame = frame
+            timestamper.stamp_start("Store")
+            self.store_frame(frame, timestamp)
+
+    def store_frame(self, frame, timestamp: float):
+        frame = crop_frame(frame, self.crop_rect)
+
+        with self.cond:
+            if not self.ring or self.ring[0].shape != frame.shape:
+                self.ring = [np.empty_like(frame) for _ in range(self.ring_size)]
+                self.first_seq = self.seq + 1
+            slot = (self.seq + 1) % self.ring_size
+            buf = self.ring[slot]
+
+        # Readers never get the slot we are writing to, so copy without the lock
+        np.copyto(buf, frame)
+        if self.recorder:
+            self.recorder.append(buf, timestamp)
+
+        with self.cond:
+            self.timestamps[slot] = timestamp
+            self.seq += 1
+            self.cond.notify_all()
+
+    def _frame(self, seq: int) -> CamFrame:
+        slot = seq % self.ring_size
+        return CamFrame(seq, self.timestamps[slot], self.ring[slot])
+
+    def _oldest_seq(self) -> int:
+        # The slot after the newest one may be getting overwritten right now
+        return max(self.first_seq, self.seq - self.ring_size + 2)
 
     def read(self):
-        with self.lock:
-            return self.frame
+        with self.cond:
+            return self.ring[self.seq % self.ring_size]
+
+    def read_next(
+        self, after_seq: int = -1, timeout: Optional[float] = None
+    ) -> Optional[CamFrame]:
+        """Wait for a frame newer than after_seq and return the newest one."""
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: self.seq > after_seq or not self.running, timeout
+            ):
+                return None
+            if self.seq <= after_seq:
+                return None
+            return self._frame(self.seq)
+
+    def read_all_since(self, seq: int) -> List[CamFrame]:
+        """All frames newer than seq that are still in the ring, oldest first."""
+        with self.cond:
+            first = max(seq + 1, self._oldest_seq())
+            return [self._frame(s) for s in range(first, self.seq + 1)]
 
     def stop(self):
         self.running = False
+        with self.cond:
+            self.cond.notify_all()
         if self.thread.is_alive():
             self.thread.join()
+        if self.recorder:
+            self.recorder.close()
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.stream.release()
+
+
+class ReplayVideoStream:
+    """Serves the frames of a recorded clip, like a WebcamVideoStream would.
+
+    Frames are views into the memory mapped clip, so nothing is copied. With
+    realtime=True frames show up with their original timing. Otherwise every
+    read_next() call that is waiting for a new frame immediately gets the next
+    one, which gives deterministic, as fast as possible, runs.
+    """
+
+    def __init__(
+        self,
+        clip_path: str,
+        realtime: bool = True,
+        ring_size: int = FRAME_RING_SIZE,
+    ):
+        self.clip = ClipReader(clip_path)
+        if not len(self.clip):
+            raise ValueError(f"{clip_path} has no frames")
+
+        self.source = clip_path
+        self.thread_name = f"Camera {self.source}"
+        self.realtime = realtime
+        self.ring_size = ring_size
+        self.running = False
+        self.thread = None
+        self.crop_rect: Optional[Rectangle] = None
+        self.cond = Condition()
+        self.fps_monitor = FPSMonitor("Camera fps")
+
+        # When each frame was made available
+        self.timestamps = [0.0] * len(self.clip)
+        self.seq = -1
+        self.publish(0)
+
+    def update_crop_rect(self, crop_rect: Rectangle):
+        self.crop_rect = crop_rect
+
+    def start(self):
+        if self.running:
+            # This can only be started once
+            return None
+        self.running = True
+        if self.realtime:
+            self.thread = Thread(target=self.update, args=(), name=self.thread_name)
+            self.thread.start()
+        return self
+
+    def update(self):
+        start = time.perf_counter()
+        first_timestamp = self.clip.timestamps[0]
+        for seq in range(1, len(self.clip)):
+            delay = (self.clip.timestamps[seq] - first_timestamp) - (
+                time.perf_counter() - start
+            )
+            if delay > 0:
+                time.sleep(delay)
+            if not self.running:
+                return
+            self.publish(seq)
+
+        self.finish()
+
+    def publish(self, seq: int):
+        self.fps_monitor.tick()
+        with self.cond:
+            self.timestamps[seq] = time.perf_counter()
+            self.seq = seq
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def finished(self) -> bool:
+        return self.seq == len(self.clip) - 1
+
+    def _frame(self, seq: int) -> CamFrame:
+        return CamFrame(
+            seq, self.timestamps[seq], crop_frame(self.clip.frames[seq], self.crop_rect)
+        )
+
+    def read(self):
+        with self.cond:
+            return self._frame(self.seq).img
+
+    def read_next(
+        self, after_seq: int = -1, timeout: Optional[float] = None
+    ) -> Optional[CamFrame]:
+        """Wait for a frame newer than after_seq and return the newest one."""
+        if not self.realtime and self.running and self.seq <= after_seq:
+            if self.finished():
+                self.finish()
+            else:
+                self.publish(self.seq + 1)
+
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: self.seq > after_seq or not self.running, timeout
+            ):
+                return None
+            if self.seq <= after_seq:
+                return None
+            return self._frame(self.seq)
+
+    def read_all_since(self, seq: int) -> List[CamFrame]:
+        """All frames newer than seq that are still "in the ring", oldest first."""
+        with self.cond:
+            first = max(seq + 1, self.seq - self.ring_size + 2, 0)
+            return [self._frame(s) for s in range(first, self.seq + 1)]
+
+    def stop(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread and self.thread.is_alive():
+            self.thread.join()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.clip.close()
@@ -0,0 +1,84 @@
+from multiprocessing.pool import Pool
+from typing import Any, Callable, List, Optional
+from CanvasMapping import CanvasMapping
+from DisplayMask import DisplayMask
+from MarkerDetector import SlotRef
+from MarkerTracker import MarkerTracker
+from SharedFrameRing import SharedFrameRing
+from Shapes import Point
+from TiledCanvas import TiledCanvas
+from Widgets import WidgetLayer
+
+
+class CameraView:
+    """A camera, the part of the canvas it looks at, and the workers that
+    detect markers in its frames."""
+
+    def __init__(
+        self,
+        cam,
+        canvas_mapping: CanvasMapping,
+        tracker: Optional[MarkerTracker] = None,
+        display_mask: Optional[DisplayMask] = None,
+    ):
+        self.cam = cam
+        self.canvas_mapping = canvas_mapping
+        # Nothing outside of the screen is interesting, so we never search there
+        self.search_bounds = canvas_mapping.frame_bounds()
+        self.tracker = tracker
+        self.display_mask = display_mask
+        self.last_seq = -1
+
+        self.frame_ring: Optional[SharedFrameRing] = None
+        self.display_mask_ring: Optional[SharedFrameRing] = None
+        self.display_mask_ref: Optional[SlotRef] = None
+        self.pool: Optional[Pool] = None
+
+    def start(self, ring_size: int, pool: Pool):
+        """pool is this camera's detection workers (see start_detector_pool),
+        which outlive the view."""
+        self.pool = pool
+        # Frames are handed to the workers through shared memory, so only slot
+        # indices (and the resulting points) go through the pool's pipes
+        self.frame_ring = SharedFrameRing(self.cam.read().shape, ring_size)
+        # Masks are written while detection goes on, workers are done with a
+        # mask by the time we wrap around to its slot
+        if self.display_mask:
+            self.display_mask_ring = SharedFrameRing(self.display_mask.mask.shape, 3)
+
+    def detect_async(
+        self, detect: Callable, frames: List, last_pos: Optional[Point]
+    ) -> Any:
+        """Starts detecting in the given frames, returns the AsyncResult."""
+        assert self.frame_ring is not None and self.pool is not None
+        search_rect = self.tracker.search_rect() if self.tracker else None
+        spec = self.frame_ring.spec()
+        params = [
+            (
+                (spec, *self.frame_ring.write(frame.img)),
+                last_pos,
+                self.canvas_mapping,
+                search_rect or self.search_bounds,
+                frame.timestamp,
+                self.display_mask_ref,
+            )
+            for frame in frames
+        ]
+        return self.pool.map_async(detect, params)
+
+    def update_display_mask(
+        self, displayed: TiledCanvas, widgets: Optional[WidgetLayer] = None
+    ):
+        if self.display_mask and self.display_mask_ring:
+            self.display_mask_ref = (
+                self.display_mask_ring.spec(),
+                *self.display_mask_ring.write(
+                    self.display_mask.update(displayed, widgets)
+                ),
+            )
+
+    def close(self):
+        if self.frame_ring:
+            self.frame_ring.close()
+        if self.display_mask_ring:
+            self.display_mask_ring.close()
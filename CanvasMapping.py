@@ -0,0 +1,95 @@
+import cv2
+import numpy as np
+from typing import Tuple, Optional
+from Shapes import Point, Rectangle
+
+
+# Left, top, right and bottom edges, as fractions of the screen
+ScreenRegion = Tuple[float, float, float, float]
+FULL_SCREEN: ScreenRegion = (0.0, 0.0, 1.0, 1.0)
+
+
+class CanvasMapping:
+    """Perspective mapping from camera frame coordinates to canvas coordinates.
+
+    The camera may only look at a region of the canvas.
+    """
+
+    def __init__(
+        self,
+        homography,
+        canvas_size: Tuple[int, int],
+        region: ScreenRegion = FULL_SCREEN,
+    ):
+        self.homography = np.asarray(homography, np.float64)
+        self.inverse = np.linalg.inv(self.homography)
+        self.canvas_size = canvas_size
+        self.region = region
+
+    @classmethod
+    def from_quad(
+        cls, quad, canvas_size: Tuple[int, int], region: ScreenRegion = FULL_SCREEN
+    ) -> "CanvasMapping":
+        # quad holds the region's corners in the camera frame, clockwise from
+        # the top left one
+        return cls(
+            cv2.getPerspectiveTransform(
+                np.float32(quad), cls.region_corners(canvas_size, region)
+            ),
+            canvas_size,
+            region,
+        )
+
+    @staticmethod
+    def region_corners(canvas_size: Tuple[int, int], region: ScreenRegion):
+        h, w = canvas_size
+        left, top, right, bottom = region
+        return np.float32(
+            [
+                [left * w, top * h],
+                [right * w, top * h],
+                [right * w, bottom * h],
+                [left * w, bottom * h],
+            ]
+        )
+
+    @staticmethod
+    def _apply(m, x, y):
+        # Works for both scalars and numpy arrays, and for a single point is a
+        # lot cheaper than cv2.perspectiveTransform
+        d = m[2, 0] * x + m[2, 1] * y + m[2, 2]
+        return (
+            (m[0, 0] * x + m[0, 1] * y + m[0, 2]) / d,
+            (m[1, 0] * x + m[1, 1] * y + m[1, 2]) / d,
+        )
+
+    def to_canvas_xy(self, x, y):
+        return self._apply(self.homography, x, y)
+
+    def to_canvas(self, x: float, y: float) -> Optional[Point]:
+        """Returns None for points that are outside of the canvas."""
+        cx, cy = self._apply(self.homography, x, y)
+        h, w = self.canvas_size
+        if not (0 <= cx < w and 0 <= cy < h):
+            return None
+        return Point(int(cx), int(cy))
+
+    def to_canvas_points(self, points) -> np.ndarray:
+        """Maps an N x 2 array of frame points, dropping the ones that are
+        outside of the canvas."""
+        xs, ys = self._apply(self.homography, points[:, 0], points[:, 1])
+        h, w = self.canvas_size
+        on_canvas = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        return np.stack([xs[on_canvas], ys[on_canvas]], axis=1)
+
+    def to_frame(self, p: Point) -> Tuple[float, float]:
+        return self._apply(self.inverse, p.x, p.y)
+
+    def frame_bounds(self) -> Rectangle:
+        """The part of the camera frame that the canvas (region) covers."""
+        corners = self.region_corners(self.canvas_size, self.region)
+        xs, ys = self._apply(self.inverse, corners[:, 0], corners[:, 1])
+        return Rectangle(
+            Point(max(0, int(np.floor(xs.min()))), max(0, int(np.floor(ys.min())))),
+            Point(int(np.ceil(xs.max())) + 1, int(np.ceil(ys.max())) + 1),
+        )
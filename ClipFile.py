@@ -0,0 +1,74 @@
+import mmap
+import struct
+import numpy as np
+from typing import List, Tuple
+from MappedFile import MappedFileWriter
+
+
+# Raw clip layout: a file header, followed by (record header, raw BGR frame)
+# pairs. Frames are stored as is, so they can be read back without copying.
+CLIP_MAGIC = b"VGCLIP01"
+FILE_HEADER = struct.Struct("<8s8x")
+# Capture timestamp, height, width, channels
+RECORD_HEADER = struct.Struct("<dIII4x")
+# The file is grown (and remapped) in chunks of this size while recording
+CLIP_CHUNK_BYTES = 256 * 1024 * 1024
+
+
+class ClipWriter:
+    def __init__(self, path: str, chunk_bytes: int = CLIP_CHUNK_BYTES):
+        self.path = path
+        self.out = MappedFileWriter(path, chunk_bytes)
+        mm, offset = self.out.append(FILE_HEADER.size)
+        FILE_HEADER.pack_into(mm, offset, CLIP_MAGIC)
+
+    def append(self, frame, timestamp: float):
+        h, w, c = frame.shape
+        mm, offset = self.out.append(RECORD_HEADER.size + frame.nbytes)
+        RECORD_HEADER.pack_into(mm, offset, timestamp, h, w, c)
+        dst = np.ndarray(
+            frame.shape, np.uint8, buffer=mm, offset=offset + RECORD_HEADER.size
+        )
+        np.copyto(dst, frame)
+        del dst
+
+    def close(self):
+        self.out.close()
+
+
+class ClipReader:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic,) = FILE_HEADER.unpack_from(self.mm, 0)
+        if magic != CLIP_MAGIC:
+            raise ValueError(f"{path} is not a clip file")
+
+        self.timestamps: List[float] = []
+        self.frames: List = []
+        offset = FILE_HEADER.size
+        while offset + RECORD_HEADER.size <= len(self.mm):
+            timestamp, h, w, c = RECORD_HEADER.unpack_from(self.mm, offset)
+            offset += RECORD_HEADER.size
+            if h * w * c == 0 or offset + h * w * c > len(self.mm):
+                # Unused space, or a partially written last frame (e.g. the
+                # recording crashed before the file was truncated)
+                break
+            # Read only views straight into the mapped file, no copies
+            self.frames.append(
+                np.ndarray((h, w, c), np.uint8, buffer=self.mm, offset=offset)
+            )
+            self.timestamps.append(timestamp)
+            offset += h * w * c
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def frame(self, i: int) -> Tuple[float, np.ndarray]:
+        return self.timestamps[i], self.frames[i]
+
+    def close(self):
+        self.frames = []
+        self.mm.close()
+        self.file.close()
@@ -0,0 +1,125 @@
+import cv2
+import numpy as np
+from typing import Dict, Optional, Tuple
+from CanvasMapping import CanvasMapping
+from TiledCanvas import TiledCanvas
+from Widgets import WidgetLayer
+
+
+# The mask is kept at 1 / DISPLAY_MASK_SCALE of the camera frame resolution
+DISPLAY_MASK_SCALE = 4
+# The canvas is shrunk by this much before being warped into camera space, so
+# that thin lines are averaged instead of skipped
+CANVAS_SCALE = 4
+# How much redder than green or blue (after shrinking) a displayed pixel has
+# to be to look like the laser to the camera. The detector only picks up red
+# hues, so white, yellow, green or blue strokes never do.
+DISPLAY_RED_THRESH = 32
+# Covers calibration errors, and the camera's blur
+DISPLAY_MASK_DILATE_KERNEL = np.ones((5, 5), np.uint8)
+
+
+def red_excess(img) -> np.ndarray:
+    """How much the red channel exceeds both green and blue, per pixel."""
+    b, g, r = cv2.split(img)
+    return cv2.subtract(r, cv2.max(g, b))
+
+
+class DisplayMask:
+    """Where the camera sees things we show that could be mistaken for the
+    laser, i.e. red strokes.
+
+    Widgets are left unmasked (unless they are red), so that pointing at them
+    keeps working.
+
+    Lives in the main process, which knows what is displayed. The mask is in
+    downscaled camera frame space, so that the detector can use it as is.
+    """
+
+    def __init__(
+        self,
+        canvas_mapping: CanvasMapping,
+        frame_shape: Tuple[int, ...],
+        scale: int = DISPLAY_MASK_SCALE,
+    ):
+        fh, fw = frame_shape[:2]
+        self.scale = scale
+        self.mask = np.zeros((fh // scale, fw // scale), np.uint8)
+        # Shrunk canvas -> canvas -> camera frame -> mask
+        self.warp = (
+            np.diag([1.0 / scale, 1.0 / scale, 1.0])
+            @ canvas_mapping.inverse
+            @ np.diag([CANVAS_SCALE, CANVAS_SCALE, 1.0])
+        )
+        # Shrunk widget sprites by (widget, sprite) ids
+        self.widget_sprites: Dict[Tuple[int, int], Tuple[int, int, np.ndarray]] = {}
+
+    def _shrunk_sprite(self, widget) -> Tuple[int, int, np.ndarray]:
+        """The widget's redness, shrunk like the canvas, and where it goes."""
+        sprite = widget.sprite()
+        key = (id(widget), id(sprite))
+        if key not in self.widget_sprites:
+            pos = widget.position
+            self.widget_sprites[key] = (
+                max(0, pos.bottom_y()) // CANVAS_SCALE,
+                max(0, pos.left_x()) // CANVAS_SCALE,
+                cv2.resize(
+                    red_excess(sprite),
+                    (
+                        max(1, pos.width() // CANVAS_SCALE),
+                        max(1, pos.height() // CANVAS_SCALE),
+                    ),
+                    interpolation=cv2.INTER_AREA,
+                ),
+            )
+        return self.widget_sprites[key]
+
+    def update(
+        self, displayed: TiledCanvas, widgets: Optional[WidgetLayer] = None
+    ) -> np.ndarray:
+        # Only the tiles that were drawn on are shrunk, the rest stays black
+        small = displayed.downscaled_plane(red_excess, CANVAS_SCALE)
+        if widgets:
+            # Widgets are shown on top of the canvas, hiding what is under them
+            for widget in widgets.widgets:
+                y, x, sprite = self._shrunk_sprite(widget)
+                sprite = sprite[: small.shape[0] - y, : small.shape[1] - x]
+                small[y : y + sprite.shape[0], x : x + sprite.shape[1]] = sprite
+        cv2.warpPerspective(
+            small,
+            self.warp,
+            (self.mask.shape[1], self.mask.shape[0]),
+            dst=self.mask,
+            flags=cv2.INTER_LINEAR,
+        )
+        cv2.threshold(
+            self.mask, DISPLAY_RED_THRESH, 255, cv2.THRESH_BINARY, dst=self.mask
+        )
+        cv2.dilate(self.mask, DISPLAY_MASK_DILATE_KERNEL, dst=self.mask)
+        return self.mask
+
+
+def suppress_display(
+    thresh,
+    mask,
+    offset: Tuple[int, int],
+    img_scale: int = 1,
+    mask_scale: int = DISPLAY_MASK_SCALE,
+):
+    """Clears thresholded pixels that are inside the display mask.
+
+    The red filter responds the same to the laser and to a red tinted stroke,
+    so there is no telling them apart inside the mask. thresh is at
+    1 / img_scale of the camera resolution, and starts at offset (in camera
+    pixels).
+    """
+    h, w = thresh.shape[:2]
+    # Maps every thresh pixel to its mask pixel
+    ratio = img_scale / mask_scale
+    to_mask = np.float32(
+        [[ratio, 0, offset[0] / mask_scale], [0, ratio, offset[1] / mask_scale]]
+    )
+    masked = cv2.warpAffine(
+        mask, to_mask, (w, h), flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP
+    )
+    cv2.subtract(thresh, masked, dst=thresh)
@@ -1,25 +1,27 @@
 import time
-from typing import List
-
-
-AVG_INTERVAL_SEC = 5
+from typing import Optional
+from Metrics import Metrics, gMetrics
 
 
 class FPSMonitor:
-    def __init__(self, name, printing_enabled=True):
+    """Records the interval between ticks into a latency histogram."""
+
+    def __init__(self, name, metrics: Optional[Metrics] = None):
         self.name = name
-        self.ticks: List[float] = []
-        self.printing_enabled = printing_enabled
+        self.metrics = metrics or gMetrics
+        self.histogram = None
+        self.last_tick = 0
 
     def tick(self):
-        self.ticks.append(time.time())
+        now = time.perf_counter_ns()
+        if self.last_tick:
+            if self.histogram is None:
+                # Created on the first tick, so it belongs to the ticking thread
+                self.histogram = self.metrics.histogram(self.name)
+            self.histogram.record(now - self.last_tick)
+        self.last_tick = now
 
-        # Check if we have ticks spanning over more than one second
-        ticks_cnt = len(self.ticks)
-        if ticks_cnt > 1:
-            span = self.ticks[-1] - self.ticks[0]
-            if span > AVG_INTERVAL_SEC:
-                current_fps = ticks_cnt / span
-                if self.printing_enabled:
-                    print(f"[{self.name}] - Current FPS: {current_fps}")
-                self.ticks = [self.ticks[-1]]
+    def fps(self) -> float:
+        if self.histogram is None or not self.histogram.count:
+            return 0.0
+        return 1e9 / self.histogram.mean_ns()
@@ -5,25 +5,57 @@ $ python Graffiti.py --video_url="http://10.0.0.3:8080/video"
 """
 
 
-import cv2
+import time
 import numpy as np
 import argparse
-import datetime
-from typing import Tuple, Optional, List, Callable
-from ImageUtils import find_marker_position_t, dist_sq, save_img_with_ts
+from typing import Tuple, Optional, List, Callable, Dict, Any, Sequence, Union
+from ImageUtils import dist_sq
+from ImageWriter import BackgroundImageWriter, FORMAT_PARAMS, DEFAULT_FORMAT
+from MarkerDetector import (
+    detect_marker_in_slot_t,
+    detect_candidates_in_slot_t,
+    start_detector_pool,
+    DETECTORS,
+    DEFAULT_DETECTOR,
+    PYRAMID_SCALE,
+)
 from ScreenUtils import (
-    show_image_fullscreen,
-    calibrate_screen_bounds,
+    ScreenCompositor,
+    calibrate_screen_quad,
+    quad_bounds,
     get_screen_size,
+    wait_key,
     init_display_window,
 )
 from CamUtils import get_cam
 from Colors import *
 from Shapes import Point, Rectangle
-from Buttons import Button
+from Buttons import Button, preload_icons
+from Widgets import WidgetLayer
 from FPSMonitor import FPSMonitor
 from Timestamper import Timestamper
-from multiprocessing import Pool
+from Metrics import gMetrics
+from MarkerTracker import MarkerTracker
+from PointerTracker import PointerTracker, PointerTrack
+from MotionPredictor import MotionPredictor
+from DisplayMask import DisplayMask
+from CanvasMapping import CanvasMapping, ScreenRegion, FULL_SCREEN
+from CameraView import CameraView
+from TiledCanvas import TiledCanvas
+from StrokeHistory import StrokeHistory, Stroke, MAX_HISTORY
+from SessionLog import (
+    SessionLogWriter,
+    EVENT_STROKE_END,
+    EVENT_CLEAR,
+    EVENT_COLOR,
+    EVENT_UNDO,
+    EVENT_REDO,
+    EVENT_DISCARD,
+)
+from LatestQueue import LatestQueue
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+from threading import Thread, Event
 
 # Performance TODOs:
 
@@ -47,6 +79,15 @@ parser.add_argument(
     help="Path to video feed (use for external camera feed)",
 )
 
+parser.add_argument(
+    "--video_decode_scale",
+    default=1,
+    type=int,
+    choices=[1, 2, 4, 8],
+    help="Decode MJPEG video feeds at 1/N of their resolution, which is a lot "
+    "cheaper (when the marker is still big enough to be found)",
+)
+
 parser.add_argument(
     "--cemera_id",
     default=None,
@@ -54,11 +95,132 @@ parser.add_argument(
     help="System id of the camera, starting from 0 (set when using device's camera)",
 )
 
+parser.add_argument(
+    "--camera",
+    default=[],
+    action="append",
+    type=str,
+    help="Camera device id or video URL, optionally followed by "
+    "@left,top,right,bottom: the region of the screen it looks at, as "
+    "fractions. Repeat for every camera of a multi camera wall (cameras "
+    "without a region split the screen into vertical strips)",
+)
+
 parser.add_argument(
     "--perf_prints",
     default=False,
     type=bool,
-    help="Enable performance debug prints",
+    help="Print a latency summary of every stage on exit",
+)
+
+parser.add_argument(
+    "--metrics_out",
+    default=None,
+    type=str,
+    help="Save the latency histograms summary on exit (.json or .csv)",
+)
+
+parser.add_argument(
+    "--record",
+    default=None,
+    type=str,
+    help="Record the camera input to this clip file",
+)
+
+parser.add_argument(
+    "--replay",
+    default=None,
+    type=str,
+    help="Use a recorded clip file instead of a camera",
+)
+
+parser.add_argument(
+    "--replay_fast",
+    action="store_true",
+    help="Replay the clip as fast as possible, instead of with its original timing",
+)
+
+parser.add_argument(
+    "--recalibrate",
+    action="store_true",
+    help="Ignore the saved screen calibration, and calibrate from scratch",
+)
+
+parser.add_argument(
+    "--save_format",
+    default=DEFAULT_FORMAT,
+    choices=sorted(FORMAT_PARAMS),
+    help="Image format for saved images",
+)
+
+parser.add_argument(
+    "--save_level",
+    default=None,
+    type=int,
+    help="Compression level (png) or quality (jpg, webp) for saved images",
+)
+
+parser.add_argument(
+    "--detector",
+    default=DEFAULT_DETECTOR,
+    choices=sorted(DETECTORS),
+    help="Marker detection algorithm",
+)
+
+parser.add_argument(
+    "--pyramid_scale",
+    default=PYRAMID_SCALE,
+    type=int,
+    choices=[2, 4],
+    help="Downscale factor for the coarse search of the pyramid detector",
+)
+
+parser.add_argument(
+    "--roi_tracking",
+    action="store_true",
+    help="Only search for the marker around its last known position",
+)
+
+parser.add_argument(
+    "--static_hold_sec",
+    default=None,
+    type=float,
+    help="Ignore red spots that stay lit for longer than this (e.g. signs or glare)",
+)
+
+parser.add_argument(
+    "--suppress_display",
+    action="store_true",
+    help="Don't mistake red things we show on screen for the laser",
+)
+
+parser.add_argument(
+    "--pointers",
+    default=1,
+    type=int,
+    help="Track up to this many pointers, each drawing its own stroke "
+    "(--roi_tracking and --predict only work with a single pointer)",
+)
+
+parser.add_argument(
+    "--predict",
+    action="store_true",
+    help="Smooth the marker's motion, and show where it is predicted to be now",
+)
+
+parser.add_argument(
+    "--undo_history",
+    default=MAX_HISTORY,
+    type=int,
+    help="How many strokes can be undone",
+)
+
+parser.add_argument(
+    "--session_log",
+    default=None,
+    type=str,
+    help="Log everything that is drawn to this file, to render a time-lapse of "
+    "the session later with RenderSession.py",
 )
 
 # TODO: All these consts are horrible, and mostly don't do what they should...
@@ -69,6 +231,13 @@ GAP_DIST = TICK_MS * 15
 BTN_CLICK_SLEEP = 100
 
 MAX_SNAPS_PER_FRAME = 4
+# Positions from different cameras that are this close (in canvas pixels and
+# time) are the same marker seen twice
+DUPLICATE_DETECTION_DIST = 40
+DUPLICATE_DETECTION_SEC = 0.02
+FRAME_TIMEOUT_SEC = 0.1
+METRICS_OVERLAY_REFRESH_SEC = 0.5
+DISPLAY_MASK_REFRESH_SEC = 0.1
 BUTTON_SCREEN_FRACTION = 0.07
 
 color_code_map = {
@@ -78,43 +247,83 @@ color_code_map = {
     "Y": YELLOW,
 }
 
+# Every pointer but the first gets its own color
+POINTER_COLORS = [GREEN, BLUE, YELLOW, WHITE, CYAN]
+
 
 class GraffitiState:
     canvas_size: Tuple[int, int]
     img_channels: int
     canvas_stretch_factor: float
+    canvas_mapping: CanvasMapping
+    search_bounds: Rectangle
     radius: int
     last_dot: Optional[Point]
+    stroke: Optional[Stroke]
     clear_cnt: int
     max_gap_dist_sq: int
-    buttons: List[Button]
+    widgets: WidgetLayer
     quit: bool
+    tracker: Optional[MarkerTracker]
+    predictor: Optional[MotionPredictor]
+    display_mask: Optional[DisplayMask]
+    pointers: Optional[PointerTracker]
+    extra_views: List[CameraView]
+    image_writer: BackgroundImageWriter
+    history: StrokeHistory
+    history_size: int
+    undo_rects: List[Rectangle]
+    session_log: Optional[SessionLogWriter]
 
     def __init__(
         self,
         canvas_size: Tuple[int, int],
         img_channels: int,
         canvas_stretch_factor: float,
+        canvas_mapping: CanvasMapping,
+        history_size: int = MAX_HISTORY,
     ):
         self.canvas_size = canvas_size
         self.img_channels = img_channels
         self.canvas_stretch_factor = canvas_stretch_factor
+        self.canvas_mapping = canvas_mapping
+        # Nothing outside of the screen is interesting, so we never search there
+        self.search_bounds = canvas_mapping.frame_bounds()
         max_gap_dist = int(GAP_DIST * canvas_stretch_factor)
         self.max_gap_dist_sq = max_gap_dist * max_gap_dist
         self.quit = False
+        self.tracker = None
+        self.predictor = None
+        self.display_mask = None
+        self.pointers = None
+        self.extra_views = []
+        self.image_writer = BackgroundImageWriter()
+        self.history_size = history_size
+        self.session_log = None
+        # The single pointer's stroke, set by clear()
+        self.last_dot: Optional[Point] = None
+        self.stroke: Optional[Stroke] = None
         self.clear()
-        self.buttons = []
+        self.widgets = WidgetLayer(canvas_size)
         button_size = int(canvas_size[1] * BUTTON_SCREEN_FRACTION)
         self.next_button_x = self.canvas_size[1] - button_size
         self.next_button_y = 0
         self.add_button(self.clear, "Icons/Clear.png", button_size)
         self.next_button_y += button_size
         self.add_button(self.save_img, "Icons/Save.png", button_size)
+        self.add_button(self.undo_button, "Icons/Undo.png", button_size, repeat=False)
+        self.add_button(self.redo_button, "Icons/Redo.png", button_size, repeat=False)
         # Put the exit button as low down as possible
         self.next_button_y = self.canvas_size[0] - button_size - 10
         self.add_button(self.set_quit, "Icons/Exit.png", button_size)
 
-    def add_button(self, callback: Callable, icon_path: str, button_size: int):
+    def add_button(
+        self,
+        callback: Callable,
+        icon_path: str,
+        button_size: int,
+        repeat: bool = True,
+    ):
         button = Button(
             callback,
             Rectangle(
@@ -124,41 +333,117 @@ class GraffitiState:
                 ),
             ),
             icon_path,
+            repeat=repeat,
         )
-        self.buttons.append(button)
+        self.widgets.add(button)
         self.next_button_y += int(button_size * 1.5)
 
     def clear_canvas(self):
-        self.canvas = gen_blank_canvas(self.canvas_size, self.img_channels)
+        # Tiles are only allocated once drawn on, so this costs nothing
+        self.canvas = TiledCanvas(self.canvas_size + (self.img_channels,))
+        self.history = StrokeHistory(self.canvas, self.history_size)
+        self.undo_rects = []
+
+    def log_event(self, kind: int, color: Tuple[int, int, int] = (0, 0, 0)):
+        if self.session_log:
+            self.session_log.event(kind, color)
 
     def clear(self):
+        self.log_event(EVENT_CLEAR)
         self.clear_canvas()
         self.last_dot = None
+        self.stroke = None
         self.color = GREEN
         self.radius = BASE_RADIUS
         self.clear_cnt = 0
+        if self.pointers:
+            self.pointers.reset()
+
+    def new_track(self, slot: int) -> PointerTrack:
+        color = self.color if slot == 0 else POINTER_COLORS[slot % len(POINTER_COLORS)]
+        return PointerTrack(slot, color, self.radius)
+
+    def tracks(self) -> List[PointerTrack]:
+        return self.pointers.tracks() if self.pointers else []
+
+    def pens(self) -> List[Any]:
+        """Everything that draws strokes, i.e. the pointers or the state itself."""
+        return self.tracks() if self.pointers else [self]
+
+    def on_button(self, pos: Point) -> bool:
+        return self.widgets.hit(pos) is not None
+
+    def end_stroke_if_idle(self):
+        if self.history.current and all(pen.last_dot is None for pen in self.pens()):
+            self.log_event(EVENT_STROKE_END)
+            self.history.end()
+
+    def undo(self):
+        # Pens that are still down continue with a new stroke
+        for pen in self.pens():
+            pen.stroke = None
+        self.log_event(EVENT_UNDO)
+        self.undo_rects += self.history.undo()
+
+    def redo(self):
+        for pen in self.pens():
+            pen.stroke = None
+        self.log_event(EVENT_REDO)
+        self.undo_rects += self.history.redo()
+
+    def discard_stroke(self):
+        """Drops what was drawn since all pens were last up, and lifts them."""
+        for pen in self.pens():
+            pen.stroke = None
+            pen.last_dot = None
+        if self.history.current:
+            self.log_event(EVENT_DISCARD)
+            self.undo_rects += self.history.discard()
+
+    def undo_button(self):
+        # Buttons are pressed by pointing at them, so the stroke in progress is
+        # only the way to the button. Undo the one before it.
+        self.discard_stroke()
+        self.undo()
+
+    def redo_button(self):
+        # The way to the button would otherwise make redo impossible
+        self.discard_stroke()
+        self.redo()
 
     def inc_radius(self):
         self.radius += 1
+        for track in self.tracks():
+            track.radius = self.radius
 
     def dec_radius(self):
         self.radius -= 1
         self.radius = max(1, self.radius)
+        for track in self.tracks():
+            track.radius = self.radius
 
     def set_color(self, color_code_char):
         if color_code_char not in color_code_map:
             return
         self.color = color_code_map[color_code_char]
+        self.log_event(EVENT_COLOR, self.color)
+        # Only the first pointer follows the keyboard
+        for track in self.tracks():
+            if track.slot == 0:
+                track.color = self.color
 
     def set_quit(self):
         self.quit = True
 
     def save_img(self):
-        save_img_with_ts(img=self.canvas, out_dir="SavedImages")
+        # Encoding (and even putting the tiles together) happens in the
+        # background, we only pay for copying the tile dict here
+        if not self.image_writer.save_canvas(self.canvas):
+            print("Too many images are already being saved, skipping")
 
 
 def get_key_press(wait_ms: int) -> Optional[str]:
-    key_code = cv2.waitKey(wait_ms)
+    key_code = wait_key(wait_ms)
     if key_code < 0:
         return None
 
@@ -170,17 +455,6 @@ def get_key_press(wait_ms: int) -> Optional[str]:
     return key.upper()
 
 
-def gen_blank_canvas(canvas_size: Tuple[int, int], img_channels: int):
-    return np.zeros(
-        (
-            canvas_size[0],
-            canvas_size[1],
-            img_channels,
-        ),
-        np.uint8,
-    )
-
-
 def calculate_canvas_size_and_stretch(
     bounds: Rectangle, rquested_canvas_size: Tuple[int, int]
 ) -> Tuple[Tuple[int, int], float]:
@@ -195,166 +469,635 @@ def calculate_canvas_size_and_stretch(
     return canvas_size, canvas_stretch_factor
 
 
-def do_graffiti(
+def create_state(
     cam,
-    bounds: Rectangle,
+    screen_quad: np.ndarray,
     rquested_canvas_size: Tuple[int, int],
-    mirror: bool = False,
-    enable_perf_prints: bool = False,
-):
+    roi_tracking: bool = False,
+    save_format: str = DEFAULT_FORMAT,
+    save_level: Optional[int] = None,
+    predict: bool = False,
+    suppress_display: bool = False,
+    max_pointers: int = 1,
+    region: ScreenRegion = FULL_SCREEN,
+    extra_cameras: Sequence[Tuple[Any, np.ndarray, ScreenRegion]] = (),
+    history_size: int = MAX_HISTORY,
+    session_log_path: Optional[str] = None,
+) -> GraffitiState:
+    """extra_cameras are (cam, screen_quad, region) of any other cameras, each
+    looking at its own region of the screen."""
     img = cam.read()
 
+    # Size the canvas as if the camera saw the whole screen
+    bounds = quad_bounds(screen_quad)
+    left, top, right, bottom = region
+    screen_bounds = Rectangle(
+        Point(0, 0),
+        Point(
+            int(bounds.width() / (right - left)), int(bounds.height() / (bottom - top))
+        ),
+    )
     canvas_size, canvas_stretch_factor = calculate_canvas_size_and_stretch(
-        bounds, rquested_canvas_size
+        screen_bounds, rquested_canvas_size
     )
     img_channels = img.shape[2]
 
-    state = GraffitiState(canvas_size, img_channels, canvas_stretch_factor)
-
-    game_loop(cam, state, mirror, enable_perf_prints)
+    # The camera frame is never cropped or warped, only detected points are
+    # mapped onto the canvas
+    canvas_mapping = CanvasMapping.from_quad(screen_quad, canvas_size, region)
 
-
-def draw_graffiti(state: GraffitiState, marker_position: Optional[Point]):
-    if marker_position:
-        if state.last_dot:
-            # Draw a line from the last position to ours
-            if dist_sq(state.last_dot, marker_position) < state.max_gap_dist_sq:
-                cv2.line(
-                    state.canvas,
-                    state.last_dot.as_tuple(),
-                    marker_position.as_tuple(),
-                    state.color,
-                    thickness=state.radius,
-                    lineType=cv2.LINE_AA,
-                )
-        state.last_dot = marker_position
-    else:
-        state.clear_cnt += 1
-
-        if state.clear_cnt > CLEAR_MS / TICK_MS:
-            state.clear_cnt = 0
-            state.last_dot = None
+    state = GraffitiState(
+        canvas_size, img_channels, canvas_stretch_factor, canvas_mapping, history_size
+    )
+    if max_pointers > 1:
+        state.pointers = PointerTracker(max_pointers, state.new_track)
+    elif roi_tracking:
+        state.tracker = MarkerTracker(state.search_bounds, canvas_mapping)
+    if predict and max_pointers == 1:
+        state.predictor = MotionPredictor()
+    if suppress_display:
+        state.display_mask = DisplayMask(canvas_mapping, img.shape)
+
+    for extra_cam, extra_quad, extra_region in extra_cameras:
+        mapping = CanvasMapping.from_quad(extra_quad, canvas_size, extra_region)
+        state.extra_views.append(
+            CameraView(
+                extra_cam,
+                mapping,
+                MarkerTracker(mapping.frame_bounds(), mapping)
+                if state.tracker
+                else None,
+                DisplayMask(mapping, extra_cam.read().shape)
+                if suppress_display
+                else None,
+            )
+        )
+    state.image_writer = BackgroundImageWriter(img_format=save_format, level=save_level)
+    if session_log_path:
+        state.session_log = SessionLogWriter(
+            session_log_path, canvas_size, history_size
+        )
+    return state
 
 
-def game_loop(
+def do_graffiti(
     cam,
-    state: GraffitiState,
-    mirror: bool,
-    enable_perf_prints: bool,
+    screen_quad: np.ndarray,
+    rquested_canvas_size: Tuple[int, int],
+    mirror: bool = False,
+    enable_perf_prints: bool = False,
+    roi_tracking: bool = False,
+    detector_name: str = DEFAULT_DETECTOR,
+    detector_options: Optional[Dict[str, Any]] = None,
+    save_format: str = DEFAULT_FORMAT,
+    save_level: Optional[int] = None,
+    predict: bool = False,
+    suppress_display: bool = False,
+    max_pointers: int = 1,
+    region: ScreenRegion = FULL_SCREEN,
+    extra_cameras: Sequence[Tuple[Any, np.ndarray, ScreenRegion]] = (),
+    history_size: int = MAX_HISTORY,
+    session_log_path: Optional[str] = None,
+    pools: Optional[List[Pool]] = None,
+    launch_time: Optional[float] = None,
 ):
-    # Clear screen
-    show_image_fullscreen(state.canvas)
-    cv2.waitKey(50)
-
-    process_pool = Pool()
-    timestamper = Timestamper(printing_enabled=enable_perf_prints)
-    fps_monitor = FPSMonitor(
-        "Main loop fps monitor", printing_enabled=enable_perf_prints
+    state = create_state(
+        cam,
+        screen_quad,
+        rquested_canvas_size,
+        roi_tracking,
+        save_format,
+        save_level,
+        predict,
+        suppress_display,
+        max_pointers,
+        region,
+        extra_cameras,
+        history_size,
+        session_log_path,
     )
 
-    while True:
-        fps_monitor.tick()
-        loop_start = datetime.datetime.now()
+    game_loop(
+        cam,
+        state,
+        mirror,
+        enable_perf_prints,
+        detector_name,
+        detector_options,
+        pools,
+        launch_time,
+    )
 
-        timestamper.stamp_start("Image reading")
-        params = [
-            (cam.read(), state.last_dot, state.canvas_stretch_factor)
-            for _ in range(MAX_SNAPS_PER_FRAME)
-        ]
 
-        timestamper.stamp_start("Marker finding")
-        maybe_positions = process_pool.map(find_marker_position_t, params)
-        marker_position = next(
-            (pos for pos in maybe_positions if pos is not None), None
-        )
+def points_bounds(points: List[Point], thickness: int) -> Rectangle:
+    # Anti aliasing can spill one more pixel past the line's thickness
+    margin = thickness // 2 + 2
+    return Rectangle(
+        Point(min(p.x for p in points) - margin, min(p.y for p in points) - margin),
+        Point(
+            max(p.x for p in points) + margin + 1,
+            max(p.y for p in points) + margin + 1,
+        ),
+    )
 
-        timestamper.stamp_start("Buttons")
 
-        clicked = None
-        for btn in state.buttons:
-            if btn.is_pressed(marker_position):
-                clicked = btn
-                btn.do_callback()
+def draw_graffiti(
+    state: GraffitiState,
+    marker_positions: List[Point],
+    track: Optional[PointerTrack] = None,
+) -> Optional[Rectangle]:
+    """Draws all the given positions (oldest first) as one polyline call.
+
+    The stroke's color, radius and gap state are the track's, or the state's
+    own when there is a single pointer.
+    Returns the part of the canvas that was drawn on, if any.
+    """
+    pen: Union[PointerTrack, GraffitiState] = track or state
+    # Pointing at a button doesn't draw, so that pressing undo doesn't start a
+    # stroke of its own
+    marker_positions = [pos for pos in marker_positions if not state.on_button(pos)]
+    if not marker_positions:
+        pen.clear_cnt += 1
+
+        if pen.clear_cnt > CLEAR_MS / TICK_MS:
+            pen.clear_cnt = 0
+            pen.last_dot = None
+            pen.stroke = None
+        return None
 
-        if state.quit:
-            return
+    # Continue from the last position, and split wherever there is a gap
+    strokes: List[List[Point]] = []
+    stroke = [pen.last_dot] if pen.last_dot else []
+    continued = stroke
+    for pos in marker_positions:
+        if stroke and dist_sq(stroke[-1], pos) >= state.max_gap_dist_sq:
+            strokes.append(stroke)
+            stroke = []
+        stroke.append(pos)
+    strokes.append(stroke)
+    pen.last_dot = marker_positions[-1]
+
+    strokes = [stroke for stroke in strokes if len(stroke) > 1]
+    if not strokes:
+        return None
 
-        timestamper.stamp_start("Drawing")
+    polylines = [
+        np.array([p.as_tuple() for p in stroke], np.int32) for stroke in strokes
+    ]
+    for stroke, points in zip(strokes, polylines):
+        if (
+            stroke is continued
+            and pen.stroke
+            and pen.stroke.color == pen.color
+            and pen.stroke.radius == pen.radius
+        ):
+            pen.stroke.extend(points[1:])
+        else:
+            pen.stroke = state.history.new_stroke(pen.color, pen.radius)
+            pen.stroke.extend(points)
+    state.canvas.polylines(polylines, pen.color, pen.radius)
+    if state.session_log:
+        for points in polylines:
+            state.session_log.segments(points, pen.color, pen.radius)
+    return points_bounds([p for stroke in strokes for p in stroke], pen.radius)
+
+
+def merge_detections(
+    view_detections: List[List[Tuple[float, Any]]]
+) -> List[Tuple[float, Any]]:
+    """Merges the (timestamp, detection) lists of all cameras, oldest first.
+
+    Where cameras overlap, they see the same marker at about the same time.
+    Such a position is only kept from the camera that saw it first.
+    """
+    merged = sorted(
+        (
+            (timestamp, i, detection)
+            for i, detections in enumerate(view_detections)
+            for timestamp, detection in detections
+            if detection is not None
+        ),
+        key=lambda entry: entry[:2],
+    )
+    if len(view_detections) < 2:
+        return [(timestamp, detection) for timestamp, _, detection in merged]
+
+    result: List[Tuple[float, Any]] = []
+    last: Optional[Tuple[float, int, Any]] = None
+    for timestamp, i, detection in merged:
+        if (
+            last is not None
+            and isinstance(detection, Point)
+            and last[1] != i
+            and timestamp - last[0] <= DUPLICATE_DETECTION_SEC
+            and dist_sq(last[2], detection) <= DUPLICATE_DETECTION_DIST**2
+        ):
+            continue
+        result.append((timestamp, detection))
+        last = (timestamp, i, detection)
+    return result
+
+
+def detection_stage(
+    views: List[CameraView],
+    state: GraffitiState,
+    detect: Callable,
+    detections_queue: LatestQueue,
+    stop: Event,
+):
+    """Detects markers in the newest frames of every camera, until stopped or
+    the (first) camera is done."""
+    cam = views[0].cam
+    timestamper = Timestamper()
+    try:
+        while not stop.is_set():
+            timestamper.stamp_start("Image reading")
+            # Block until the (first) camera has something we haven't seen
+            # yet, then only look at the newest unseen frames of every camera.
+            # Older ones are stale by now, and are dropped.
+            cam.read_next(views[0].last_seq, timeout=FRAME_TIMEOUT_SEC)
+            view_frames = []
+            for view in views:
+                frames = view.cam.read_all_since(view.last_seq)[-MAX_SNAPS_PER_FRAME:]
+                if frames:
+                    view.last_seq = frames[-1].seq
+                view_frames.append(frames)
+            if not view_frames[0]:
+                if not cam.running:
+                    return
+                continue
+
+            timestamper.stamp_start("Marker finding")
+            # All cameras are processed at the same time
+            results = [
+                view.detect_async(detect, frames, state.last_dot)
+                for view, frames in zip(views, view_frames)
+            ]
+            detections = merge_detections(
+                [
+                    list(zip([frame.timestamp for frame in frames], result.get()))
+                    for frames, result in zip(view_frames, results)
+                ]
+            )
+            if not state.pointers:
+                # The search windows follow the most recent position
+                marker_position = detections[-1][1] if detections else None
+                for view in views:
+                    if view.tracker:
+                        view.tracker.update(marker_position)
+            detections_queue.put(detections)
+    finally:
+        detections_queue.close()
 
-        draw_graffiti(state, marker_position)
 
-        # Ideally we would want to copy the canvas here, but this takes unberablly long
-        # (~15ms on my laptop).
-        # We avoid that and simply re-draw the buttons again and again on the
-        # original canvas.
-        draw = state.canvas
+def start_detector_pools(
+    cam_cnt: int,
+    detector_name: str = DEFAULT_DETECTOR,
+    detector_options: Optional[Dict[str, Any]] = None,
+) -> List[Pool]:
+    # Every camera gets its own workers, sharing the cores between them
+    processes = max(1, cpu_count() // cam_cnt) if cam_cnt > 1 else None
+    return [
+        start_detector_pool(detector_name, detector_options, processes)
+        for _ in range(cam_cnt)
+    ]
 
-        for bnt in state.buttons:
-            bnt.draw(draw, marker_position)
 
-        timestamper.stamp_start("Display")
+def game_loop(
+    cam,
+    state: GraffitiState,
+    mirror: bool,
+    enable_perf_prints: bool,
+    detector_name: str = DEFAULT_DETECTOR,
+    detector_options: Optional[Dict[str, Any]] = None,
+    pools: Optional[List[Pool]] = None,
+    launch_time: Optional[float] = None,
+):
+    """pools are the detection workers of every camera, if they were already
+    started (they are then left running). launch_time is what the time to the
+    first stroke is measured from, when the loop started if not given."""
+    launch_time = launch_time or time.perf_counter()
+
+    views = [
+        CameraView(cam, state.canvas_mapping, state.tracker, state.display_mask)
+    ] + state.extra_views
+    own_pools = pools is None
+    if pools is None:
+        pools = start_detector_pools(len(views), detector_name, detector_options)
+    for view, pool in zip(views, pools):
+        view.start(MAX_SNAPS_PER_FRAME, pool)
+    detect = detect_candidates_in_slot_t if state.pointers else detect_marker_in_slot_t
+    compositor = ScreenCompositor(state.canvas.shape, mirror, widgets=state.widgets)
+    # Clear screen
+    compositor.show(state.canvas, [])
+    wait_key(50)
+    timestamper = Timestamper()
+    fps_monitor = FPSMonitor("Main loop fps")
+
+    # Toggled with "P", refreshed every now and then rather than every frame
+    show_metrics = False
+    metrics_lines: Optional[List[str]] = None
+    metrics_refresh_time = 0.0
+
+    # How long it takes from showing a frame until it is on screen
+    show_sec = 0.0
+
+    # The display mask is rebuilt when what we show changes, but not too often
+    display_changed = True
+    display_mask_refresh_time = 0.0
+    displayed_canvas = None
+
+    first_stroke_shown = False
+
+    # Detection runs on its own thread, so the next frames are processed while
+    # this one draws and shows the previous ones. Detections that are not
+    # taken yet are merged rather than dropped, not to lose stroke points.
+    detections_queue = LatestQueue(merge=lambda older, newer: older + newer)
+    stop_detection = Event()
+    detection_thread = Thread(
+        target=detection_stage,
+        args=(views, state, detect, detections_queue, stop_detection),
+        name="Detection",
+    )
+    detection_thread.start()
 
-        show_image_fullscreen(draw, mirror)
+    try:
+        while True:
+            fps_monitor.tick()
+
+            timestamper.stamp_start("Waiting for detections")
+            detections = detections_queue.get(timeout=FRAME_TIMEOUT_SEC)
+            if detections is None:
+                if detections_queue.closed:
+                    # The camera (or recorded clip) is done
+                    return
+                detections = []
+
+            timestamper.stamp_start("Tracking")
+            if state.pointers:
+                # Frames are oldest first, so are the positions of each track
+                for _, candidates in detections:
+                    state.pointers.update(candidates)
+                pointer_positions = [
+                    track.new_positions[-1]
+                    for track in state.pointers.tracks()
+                    if track.new_positions
+                ]
+            else:
+                # The last position is the most recent
+                marker_positions = [pos for _, pos in detections]
+                pointer_positions = marker_positions[-1:]
+
+            timestamper.stamp_start("Buttons")
+
+            clicked = state.widgets.press(pointer_positions)
+
+            for path, error in state.image_writer.poll_completed():
+                if error:
+                    print(f"Failed saving image to {path}: {error}")
+                else:
+                    print(f"Image saved to {path}")
+
+            if state.quit:
+                return
+
+            timestamper.stamp_start("Drawing")
+
+            if state.predictor:
+                # The smoothed positions are what ends up on the canvas
+                marker_positions = [
+                    state.predictor.update(pos, timestamp)
+                    for timestamp, pos in detections
+                ]
+
+            if clicked and not clicked.repeat:
+                # The button already acted on the strokes (e.g. undo), so what
+                # led up to it in this tick is not drawn as a new one
+                marker_positions = []
+                for track in state.tracks():
+                    track.new_positions = []
+
+            if state.pointers:
+                stroke_rects = []
+                for track in state.pointers.tracks():
+                    stroke_rects.append(
+                        draw_graffiti(state, track.new_positions, track)
+                    )
+                    track.new_positions = []
+            else:
+                stroke_rects = [draw_graffiti(state, marker_positions)]
+            state.end_stroke_if_idle()
+            # Undone or redone strokes change the canvas just like new ones
+            stroke_rects += state.undo_rects
+            state.undo_rects = []
+            dirty_rects = list(stroke_rects)
+
+            provisional_line = None
+            if state.predictor:
+                if state.last_dot is None:
+                    state.predictor.reset()
+                else:
+                    # Extend the stroke to where the marker should be by the
+                    # time this frame is on screen. It is replaced by the real
+                    # stroke once the frames from that time are processed.
+                    predicted = state.predictor.predict(time.perf_counter() + show_sec)
+                    if predicted is not None:
+                        provisional_line = (
+                            state.last_dot,
+                            predicted,
+                            state.color,
+                            state.radius,
+                        )
+
+            # Buttons are not part of the canvas, the compositor puts them on top
+            draw = state.canvas
+
+            if state.display_mask:
+                display_changed |= any(stroke_rects)
+                display_changed |= bool(state.widgets.changed)
+                display_changed |= draw is not displayed_canvas
+                displayed_canvas = draw
+                now = time.perf_counter()
+                if display_changed and now >= display_mask_refresh_time:
+                    for view in views:
+                        view.update_display_mask(draw, state.widgets)
+                    display_changed = False
+                    display_mask_refresh_time = now + DISPLAY_MASK_REFRESH_SEC
+
+            timestamper.stamp_start("Display")
+
+            if show_metrics and time.perf_counter() >= metrics_refresh_time:
+                metrics_lines = [
+                    f"Main loop: {fps_monitor.fps():.1f} fps, "
+                    f"camera: {cam.fps_monitor.fps():.1f} fps"
+                ] + gMetrics.summary_lines()
+                metrics_refresh_time = time.perf_counter() + METRICS_OVERLAY_REFRESH_SEC
+
+            show_start = time.perf_counter()
+            compositor.show(draw, dirty_rects, metrics_lines, provisional_line)
+            if not first_stroke_shown and any(stroke_rects):
+                first_stroke_shown = True
+                gMetrics.record(
+                    "Time to first stroke",
+                    int((time.perf_counter() - launch_time) * 1e9),
+                )
 
-        timestamper.stamp_start("Sleep")
+            # No need to sleep here, waiting for the next detections is what
+            # paces the loop
+            sleep_millis = 1
+            if clicked:
+                sleep_millis = BTN_CLICK_SLEEP
+
+            timestamper.stamp_start("Image show")
+            k = get_key_press(sleep_millis)
+            if not clicked:
+                show_sec = time.perf_counter() - show_start
+
+            # Keyboard meta commands
+            if k == "C":
+                # Clear command
+                state.clear()
+            if k in color_code_map:
+                # Color change command
+                state.set_color(k)
+            elif k == "[":
+                state.inc_radius()
+            elif k == "]":
+                state.dec_radius()
+            elif k == "S":
+                state.save_img()
+            elif k == "U":
+                state.undo()
+            elif k == "R":
+                state.redo()
+            elif k == "P":
+                # Performance metrics overlay
+                show_metrics = not show_metrics
+                metrics_lines = None
+                metrics_refresh_time = 0.0
+            elif k == "Q":
+                # Quit
+                return
 
-        loop_end = datetime.datetime.now()
-        delta = loop_end - loop_start
-        delta_ms = int(delta.total_seconds() * 1000)
-        required_sleep_millis = TICK_MS - delta_ms
+    finally:
+        stop_detection.set()
+        detection_thread.join()
+        for view in views:
+            view.close()
+        if own_pools:
+            for pool in pools:
+                pool.terminate()
+        state.image_writer.stop()
+        if state.session_log:
+            state.session_log.close()
+        if enable_perf_prints:
+            print("\n".join(gMetrics.summary_lines()))
+
+
+def detector_options_from_args(args) -> Dict[str, Any]:
+    options: Dict[str, Any] = {"static_hold_sec": args.static_hold_sec}
+    if args.detector == "pyramid":
+        options["scale"] = args.pyramid_scale
+    return options
+
+
+def parse_camera(spec: str) -> Tuple[str, Optional[ScreenRegion]]:
+    """Splits "source[@left,top,right,bottom]" into its parts."""
+    source, _, region = spec.rpartition("@")
+    try:
+        left, top, right, bottom = (float(edge) for edge in region.split(","))
+    except ValueError:
+        # Not a region, e.g. a URL with a user name
+        return spec, None
+    return source, (left, top, right, bottom)
 
-        sleep_millis = max(1, required_sleep_millis)
 
-        if clicked:
-            sleep_millis = BTN_CLICK_SLEEP
+def strip_region(i: int, cnt: int) -> ScreenRegion:
+    return (i / cnt, 0.0, (i + 1) / cnt, 1.0)
 
-        timestamper.stamp_start("Image show")
-        k = get_key_press(sleep_millis)
 
-        # Keyboard meta commands
-        if k == "C":
-            # Clear command
-            state.clear()
-        if k in color_code_map:
-            # Color change command
-            state.set_color(k)
-        elif k == "[":
-            state.inc_radius()
-        elif k == "]":
-            state.dec_radius()
-        elif k == "S":
-            state.save_img()
-        elif k == "Q":
-            # Quit
-            return
+def open_cameras(args) -> Tuple[List[Any], List[ScreenRegion]]:
+    if not args.camera:
+        cam = get_cam(
+            video_url=args.video_url,
+            camera_id=args.cemera_id,
+            record_path=args.record,
+            replay_path=args.replay,
+            replay_realtime=not args.replay_fast,
+            decode_scale=args.video_decode_scale,
+        )
+        return [cam], [FULL_SCREEN]
+
+    cams = []
+    regions = []
+    specs = [parse_camera(spec) for spec in args.camera]
+    for i, (source, region) in enumerate(specs):
+        cams.append(
+            get_cam(
+                video_url=None if source.isdigit() else source,
+                camera_id=int(source) if source.isdigit() else None,
+                # Only the first camera is recorded
+                record_path=args.record if i == 0 else None,
+                decode_scale=args.video_decode_scale,
+            )
+        )
+        regions.append(region or strip_region(i, len(specs)))
+    return cams, regions
 
 
 def main():
+    launch_time = time.perf_counter()
     args = parser.parse_args()
 
+    # The workers start up and warm up while the cameras are opened and
+    # calibrated. They are forked before any window or camera thread exists.
+    pools = start_detector_pools(
+        len(args.camera) or 1, args.detector, detector_options_from_args(args)
+    )
     init_display_window()
+    # Button icons are read while calibrating, off the path to the first frame
+    Thread(target=preload_icons, daemon=True).start()
 
-    cam_stream = get_cam(
-        video_url=args.video_url,
-        camera_id=args.cemera_id,
-        enable_perf_prints=args.perf_prints,
-    )
+    cams, regions = open_cameras(args)
     try:
-        bounds = calibrate_screen_bounds(cam_stream)
-
-        if not bounds:
-            cam_stream.stop()
-            return
+        screen_quads = []
+        for cam, region in zip(cams, regions):
+            screen_quad = calibrate_screen_quad(
+                cam,
+                recalibrate=args.recalibrate,
+                region=None if region == FULL_SCREEN else region,
+            )
+            if screen_quad is None:
+                return
+            screen_quads.append(screen_quad)
 
-        cam_stream.update_crop_rect(bounds)
         do_graffiti(
-            cam=cam_stream,
-            bounds=bounds,
+            cam=cams[0],
+            screen_quad=screen_quads[0],
+            region=regions[0],
+            extra_cameras=list(zip(cams[1:], screen_quads[1:], regions[1:])),
             rquested_canvas_size=get_screen_size(),
             enable_perf_prints=args.perf_prints,
+            roi_tracking=args.roi_tracking,
+            predict=args.predict,
+            suppress_display=args.suppress_display,
+            max_pointers=args.pointers,
+            detector_name=args.detector,
+            detector_options=detector_options_from_args(args),
+            save_format=args.save_format,
+            save_level=args.save_level,
+            history_size=args.undo_history,
+            session_log_path=args.session_log,
+            pools=pools,
+            launch_time=launch_time,
         )
     finally:
-        cam_stream.stop()
+        for pool in pools:
+            pool.terminate()
+        for cam in cams:
+            cam.stop()
+        if args.metrics_out:
+            gMetrics.export(args.metrics_out)
 
 
 if __name__ == "__main__":
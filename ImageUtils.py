@@ -1,9 +1,8 @@
 import cv2
 import numpy as np
-from typing import Tuple, Optional, Any
+from typing import Tuple, Optional, Any, List
 from Colors import *
-from Shapes import Point
-import time
+from Shapes import Point, Rectangle
 
 
 def _create_hue_mask(img, lower_hue: int, upper_hue: int):
@@ -43,10 +42,6 @@ def filter_cyan(img):
     return filter_color_hsv(img, CYAN_LOWER_HUE, CYAN_UPPER_HUE)
 
 
-def filter_red_hsv_inverse(img):
-    return filter_cyan(cv2.bitwise_not(img))
-
-
 def has_min_size(c, min_size) -> bool:
     peri = cv2.arcLength(c, True)
     approx = cv2.approxPolyDP(c, 0.04 * peri, True)
@@ -61,34 +56,22 @@ def dist_sq(p1: Point, p2: Point) -> int:
     return (p1.x - p2.x) * (p1.x - p2.x) + (p1.y - p2.y) * (p1.y - p2.y)
 
 
-def contour_center(cnt, canvas_stretch_factor) -> Point:
-    c, _ = cv2.minEnclosingCircle(cnt)
-
-    # Our canvas is bigger than the img, adjust for that
-    return Point(int(c[0] * canvas_stretch_factor), int(c[1] * canvas_stretch_factor))
-
-
-def find_marker_position_t(args: Tuple[Any, Optional[Point], float]):
-    return find_marker_position(*args)
+def crop_to_search_rect(
+    img, search_rect: Optional[Rectangle]
+) -> Tuple[Any, Tuple[int, int]]:
+    if not search_rect:
+        return img, (0, 0)
 
+    # Only look around where the marker is expected to be (this is a view,
+    # not a copy)
+    cropped = img[
+        search_rect.bottom_y() : search_rect.top_y(),
+        search_rect.left_x() : search_rect.right_x(),
+    ]
+    return cropped, (search_rect.left_x(), search_rect.bottom_y())
 
-def find_marker_position(
-    img, last_pos: Optional[Point], canvas_stretch_factor: float
-) -> Optional[Point]:
-    filtered = filter_red_hsv_inverse(img)
 
-    blurred = cv2.GaussianBlur(filtered, (7, 7), 2, 2)
-    thresh = cv2.threshold(blurred, MIN_VISIBLE_THRESH, 255, cv2.THRESH_BINARY)[1]
-    cnts, _ = cv2.findContours(
-        thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-    )[-2:]
-
-    # # Hyper debug mode: (WARNING: Will trigger epilepsy. Use at your own risk)
-    # from ScreenUtils import show_img_fullscreen
-    # show_img_fullscreen(thresh)
-    # cv2.waitKey(50)
-
-    points = [contour_center(cnt, canvas_stretch_factor) for cnt in cnts]
+def closest_point(points: List[Point], last_pos: Optional[Point]) -> Optional[Point]:
     if not points:
         return None
 
@@ -100,10 +83,3 @@ def find_marker_position(
 
     # If we have a few findings, filter to the one closest to the last dot
     return min(points, key=lambda x: dist_sq(x, last_pos_point))
-
-
-def save_img_with_ts(img, out_dir: str):
-    save_timestamp = time.time()
-    outpath = f"{out_dir}/{save_timestamp}.png"
-    cv2.imwrite(outpath, img)
-    print(f"Image saved to {outpath}")
@@ -0,0 +1,111 @@
+import os
+import cv2
+import time
+from queue import Queue, Full, Empty
+from threading import Thread
+from typing import Optional, List, Tuple
+from TiledCanvas import TiledCanvas
+
+
+DEFAULT_OUT_DIR = "SavedImages"
+DEFAULT_FORMAT = "png"
+# Max pending saves, anything more than that is dropped
+SAVE_QUEUE_SIZE = 4
+
+# Format -> (imwrite param, default value)
+FORMAT_PARAMS = {
+    "png": (cv2.IMWRITE_PNG_COMPRESSION, 3),
+    "jpg": (cv2.IMWRITE_JPEG_QUALITY, 95),
+    "webp": (cv2.IMWRITE_WEBP_QUALITY, 95),
+}
+
+
+def timestamped_path(out_dir: str, img_format: str = DEFAULT_FORMAT) -> str:
+    return f"{out_dir}/{time.time()}.{img_format}"
+
+
+def write_params(img_format: str, level: Optional[int] = None) -> List[int]:
+    """imwrite params for the given format's compression level / quality."""
+    param, default_level = FORMAT_PARAMS[img_format]
+    return [param, default_level if level is None else level]
+
+
+class BackgroundImageWriter:
+    """Encodes and writes images on a separate thread.
+
+    The caller only pays for one copy of the image, or none for a canvas.
+    Finished saves can be collected with poll_completed().
+    """
+
+    def __init__(
+        self,
+        out_dir: str = DEFAULT_OUT_DIR,
+        img_format: str = DEFAULT_FORMAT,
+        level: Optional[int] = None,
+        queue_size: int = SAVE_QUEUE_SIZE,
+    ):
+        self.out_dir = out_dir
+        self.img_format = img_format
+        self.params = write_params(img_format, level)
+        self.pending: Queue = Queue(maxsize=queue_size)
+        # (path, error message or None)
+        self.completed: Queue = Queue()
+        self.thread: Optional[Thread] = None
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, img, out_dir: Optional[str] = None) -> bool:
+        """Queues a copy of img for saving. Returns False if the queue is full."""
+        return self._queue(img.copy(), out_dir)
+
+    def save_canvas(self, canvas: TiledCanvas, out_dir: Optional[str] = None) -> bool:
+        """Like save(), but only the canvas' tile dict is copied here. Its tiles
+        are copied on write, and put together into an image on the writer
+        thread."""
+        return self._queue(canvas.snapshot(), out_dir)
+
+    def _queue(self, img, out_dir: Optional[str]) -> bool:
+        self.start()
+        path = timestamped_path(out_dir or self.out_dir, self.img_format)
+        try:
+            self.pending.put_nowait((path, img))
+        except Full:
+            return False
+        return True
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            path, img = item
+            error = None
+            try:
+                if isinstance(img, TiledCanvas):
+                    img = img.to_array()
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                if not cv2.imwrite(path, img, self.params):
+                    error = "imwrite failed"
+            except (OSError, cv2.error) as e:
+                error = str(e)
+            self.completed.put((path, error))
+
+    def poll_completed(self) -> List[Tuple[str, Optional[str]]]:
+        completed = []
+        while True:
+            try:
+                completed.append(self.completed.get_nowait())
+            except Empty:
+                return completed
+
+    def stop(self):
+        """Waits for all pending saves to finish."""
+        if not self.thread:
+            return
+        self.pending.put(None)
+        self.thread.join()
+        self.thread = None
@@ -0,0 +1,47 @@
+from threading import Condition
+from typing import Any, Callable, Optional
+
+
+class LatestQueue:
+    """A queue between two pipeline stages that only holds the newest item.
+
+    Putting an item replaces the one still waiting, so the consumer never works
+    on something stale. When nothing may be lost (e.g. marker positions), a
+    merge function combines the waiting item with the new one instead.
+    """
+
+    def __init__(self, merge: Optional[Callable[[Any, Any], Any]] = None):
+        self.merge = merge
+        self.cond = Condition()
+        self.item: Any = None
+        self.pending = False
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if self.pending:
+                if self.merge:
+                    item = self.merge(self.item, item)
+                else:
+                    self.dropped += 1
+            self.item = item
+            self.pending = True
+            self.cond.notify_all()
+
+    def get(self, timeout: Optional[float] = None):
+        """Returns the waiting item, or None on timeout or once closed."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending or self.closed, timeout)
+            if not self.pending:
+                return None
+            item = self.item
+            self.item = None
+            self.pending = False
+            return item
+
+    def close(self):
+        """No more items are coming, wakes up the consumer."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
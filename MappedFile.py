@@ -0,0 +1,41 @@
+import mmap
+from typing import Optional, Tuple
+
+
+class MappedFileWriter:
+    """An append only file, written through a memory mapping.
+
+    The file is grown (and remapped) in chunks of chunk_bytes, and cut to
+    what was written when closed. Views into the mapping must be gone before
+    the next append, which may remap it.
+    """
+
+    def __init__(self, path: str, chunk_bytes: int):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.file = open(path, "w+b")
+        self.mm: Optional[mmap.mmap] = None
+        self.capacity = 0
+        self.size = 0
+
+    def append(self, n: int) -> Tuple[mmap.mmap, int]:
+        """Makes room for n more bytes, returns the mapping and their offset."""
+        if self.mm is None or self.size + n > self.capacity:
+            if self.mm is not None:
+                self.mm.close()
+            self.capacity = max(self.capacity + self.chunk_bytes, self.size + n)
+            self.file.truncate(self.capacity)
+            self.mm = mmap.mmap(self.file.fileno(), self.capacity)
+        offset = self.size
+        self.size += n
+        return self.mm, offset
+
+    def close(self):
+        if self.mm is None:
+            return
+        self.mm.flush()
+        self.mm.close()
+        self.mm = None
+        # Drop the unused part of the last chunk
+        self.file.truncate(self.size)
+        self.file.close()
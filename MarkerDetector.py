@@ -0,0 +1,436 @@
+import os
+import cv2
+import time
+import numpy as np
+from multiprocessing.pool import Pool
+from typing import Tuple, Optional, Any, Dict
+from Colors import *
+from Shapes import Point, Rectangle
+from CanvasMapping import CanvasMapping
+from ImageUtils import (
+    closest_point,
+    crop_to_search_rect,
+)
+from SharedFrameRing import SharedFrameRing, FrameRingSpec
+from PersistenceMask import PersistenceMask, CELL_SIZE
+from DisplayMask import suppress_display
+
+
+class MarkerDetector:
+    def __init__(
+        self,
+        lower_hue: int = CYAN_LOWER_HUE,
+        upper_hue: int = CYAN_UPPER_HUE,
+        static_hold_sec: Optional[float] = None,
+    ):
+        # Classification bounds are built once, not on every frame
+        self.hue_ranges = [(lower_hue, upper_hue)]
+        if upper_hue < lower_hue:  # This means we have a wrap around!
+            self.hue_ranges = [(lower_hue, 179), (0, upper_hue)]
+        self.bounds = [
+            (
+                np.array([lower, MIN_SATURATION, MIN_VALUE], np.uint8),
+                np.array([upper, 255, 255], np.uint8),
+            )
+            for lower, upper in self.hue_ranges
+        ]
+        self.frame_size = (0, 0)
+        # Ignores spots that are lit for longer than static_hold_sec
+        self.persistence = (
+            PersistenceMask(static_hold_sec, self.persistence_cell_size())
+            if static_hold_sec
+            else None
+        )
+
+    def persistence_cell_size(self) -> int:
+        return CELL_SIZE
+
+    def _mask_static(self, thresh, offset: Tuple[int, int], timestamp: Optional[float]):
+        if self.persistence:
+            self.persistence.apply(
+                thresh, offset, time.perf_counter() if timestamp is None else timestamp
+            )
+
+    def _ensure_buffers(self, h: int, w: int):
+        if h <= self.frame_size[0] and w <= self.frame_size[1]:
+            return
+
+        h = max(h, self.frame_size[0])
+        w = max(w, self.frame_size[1])
+        self.frame_size = (h, w)
+        self.inverted = np.empty((h, w, 3), np.uint8)
+        self.hsv = np.empty((h, w, 3), np.uint8)
+        self.mask = np.empty((h, w), np.uint8)
+        self.wrap_mask = np.empty((h, w), np.uint8)
+        self.grey = np.empty((h, w), np.uint8)
+        self.filtered = np.empty((h, w), np.uint8)
+        self.blurred = np.empty((h, w), np.uint8)
+        self.thresh = np.empty((h, w), np.uint8)
+
+    def filter_red(self, img):
+        """The cyan of the inverted image (i.e. the red), without any allocations."""
+        h, w = img.shape[:2]
+        self._ensure_buffers(h, w)
+        inverted = self.inverted[:h, :w]
+        hsv = self.hsv[:h, :w]
+        mask = self.mask[:h, :w]
+        grey = self.grey[:h, :w]
+        filtered = self.filtered[:h, :w]
+
+        cv2.bitwise_not(img, dst=inverted)
+        cv2.cvtColor(inverted, cv2.COLOR_BGR2HSV, dst=hsv)
+
+        lower, upper = self.bounds[0]
+        cv2.inRange(hsv, lower, upper, dst=mask)
+        if len(self.bounds) > 1:
+            # The hue ranges are disjoint, so blending the two masked images
+            # is the same as halving the union of both
+            wrap_mask = self.wrap_mask[:h, :w]
+            lower, upper = self.bounds[1]
+            cv2.inRange(hsv, lower, upper, dst=wrap_mask)
+            cv2.bitwise_or(mask, wrap_mask, dst=mask)
+            cv2.addWeighted(hsv, 0.5, hsv, 0.0, 0.0, dst=inverted)
+            hsv = inverted
+
+        # Masking the grey image is the same as taking the grey of the masked
+        # image, but only touches one channel
+        cv2.cvtColor(hsv, cv2.COLOR_BGR2GRAY, dst=grey)
+        cv2.bitwise_and(grey, mask, dst=filtered)
+        return filtered
+
+    def _crop(self, img, search_rect: Optional[Rectangle]):
+        if self.persistence:
+            search_rect = self.persistence.align(search_rect)
+        return crop_to_search_rect(img, search_rect)
+
+    def _threshold(
+        self, img, offset: Tuple[int, int], timestamp: Optional[float], display_mask
+    ):
+        h, w = img.shape[:2]
+        filtered = self.filter_red(img)
+        blurred = self.blurred[:h, :w]
+        thresh = self.thresh[:h, :w]
+
+        cv2.GaussianBlur(filtered, (7, 7), 2, dst=blurred, sigmaY=2)
+        cv2.threshold(blurred, MIN_VISIBLE_THRESH, 255, cv2.THRESH_BINARY, dst=thresh)
+        if display_mask is not None:
+            suppress_display(thresh, display_mask, offset)
+        self._mask_static(thresh, offset, timestamp)
+        return thresh
+
+    def find_marker_candidates(
+        self,
+        img,
+        canvas_mapping: CanvasMapping,
+        search_rect: Optional[Rectangle] = None,
+        timestamp: Optional[float] = None,
+        display_mask=None,
+    ) -> np.ndarray:
+        """All spots that could be a marker, as an N x 2 array of canvas
+        positions."""
+        img, offset = self._crop(img, search_rect)
+        thresh = self._threshold(img, offset, timestamp, display_mask)
+        # findContours does not modify its input since OpenCV 3.2, so no copy
+        cnts, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[
+            -2:
+        ]
+
+        centers = np.float64([cv2.minEnclosingCircle(cnt)[0] for cnt in cnts])
+        return canvas_mapping.to_canvas_points(centers.reshape(-1, 2) + offset)
+
+    def find_marker_position(
+        self,
+        img,
+        last_pos: Optional[Point],
+        canvas_mapping: CanvasMapping,
+        search_rect: Optional[Rectangle] = None,
+        timestamp: Optional[float] = None,
+        display_mask=None,
+    ) -> Optional[Point]:
+        candidates = self.find_marker_candidates(
+            img, canvas_mapping, search_rect, timestamp, display_mask
+        )
+        points = [Point(int(x), int(y)) for x, y in candidates]
+        return closest_point(points, last_pos)
+
+
+# Downscale factor for the coarse search
+PYRAMID_SCALE = 4
+# Extra full resolution pixels around a candidate when refining it
+REFINE_MARGIN = 4
+# At most this many candidates are refined when looking for all of them
+MAX_CANDIDATES = 16
+
+
+class PyramidMarkerDetector(MarkerDetector):
+    """Finds candidates on a downscaled frame, and only refines the best one
+    (or the biggest ones) at full resolution."""
+
+    def __init__(self, scale: int = PYRAMID_SCALE, **kwargs):
+        # Needed by the base class to size its persistence cells
+        self.scale = scale
+        super().__init__(**kwargs)
+        self.small_size = (0, 0)
+
+    def persistence_cell_size(self) -> int:
+        # The model works on the downscaled frame
+        return max(1, CELL_SIZE // self.scale)
+
+    def _ensure_small_buffers(self, h: int, w: int):
+        if h <= self.small_size[0] and w <= self.small_size[1]:
+            return
+
+        h = max(h, self.small_size[0])
+        w = max(w, self.small_size[1])
+        self.small_size = (h, w)
+        self.small = np.empty((h, w, 3), np.uint8)
+        self.small_thresh = np.empty((h, w), np.uint8)
+        self.labels = np.empty((h, w), np.int32)
+
+    def _components(
+        self, img, offset: Tuple[int, int], timestamp: Optional[float], display_mask
+    ):
+        """Stats and centroids of the spots on the downscaled frame."""
+        h, w = img.shape[:2]
+        sh, sw = h // self.scale, w // self.scale
+        if sh == 0 or sw == 0:
+            return np.empty((0, 5), np.int32), np.empty((0, 2))
+        self._ensure_small_buffers(sh, sw)
+        small = self.small[:sh, :sw]
+        small_thresh = self.small_thresh[:sh, :sw]
+        labels = self.labels[:sh, :sw]
+
+        # INTER_LINEAR samples the middle of each scale x scale block, which is
+        # enough to hit any spot wider than the scale, and is several times
+        # faster than INTER_AREA. The marker is only a few pixels wide after
+        # downscaling, so we don't blur here.
+        cv2.resize(img, (sw, sh), dst=small, interpolation=cv2.INTER_LINEAR)
+        filtered = self.filter_red(small)
+        cv2.threshold(
+            filtered, MIN_VISIBLE_THRESH, 255, cv2.THRESH_BINARY, dst=small_thresh
+        )
+        if display_mask is not None:
+            suppress_display(small_thresh, display_mask, offset, img_scale=self.scale)
+        self._mask_static(
+            small_thresh,
+            (offset[0] // self.scale, offset[1] // self.scale),
+            timestamp,
+        )
+        _, _, stats, centroids = cv2.connectedComponentsWithStats(
+            small_thresh, labels=labels
+        )
+        # Label 0 is the background
+        return stats[1:], centroids[1:]
+
+    def _refine(self, img, stats, centroid) -> Tuple[float, float]:
+        h, w = img.shape[:2]
+        x, y, bw, bh = stats[:4] * self.scale
+        left_x = max(0, x - REFINE_MARGIN)
+        bottom_y = max(0, y - REFINE_MARGIN)
+        patch = img[
+            bottom_y : min(h, y + bh + self.scale + REFINE_MARGIN),
+            left_x : min(w, x + bw + self.scale + REFINE_MARGIN),
+        ]
+        center = self._weighted_center(patch)
+        if center is None:
+            return tuple(self._to_full_res(centroid))
+        return center[0] + left_x, center[1] + bottom_y
+
+    def find_marker_candidates(
+        self,
+        img,
+        canvas_mapping: CanvasMapping,
+        search_rect: Optional[Rectangle] = None,
+        timestamp: Optional[float] = None,
+        display_mask=None,
+    ) -> np.ndarray:
+        img, offset = self._crop(img, search_rect)
+        stats, centroids = self._components(img, offset, timestamp, display_mask)
+
+        full_res = self._to_full_res(centroids) + offset
+        xs, ys = canvas_mapping.to_canvas_xy(full_res[:, 0], full_res[:, 1])
+        h, w = canvas_mapping.canvas_size
+        on_canvas = np.flatnonzero((xs >= 0) & (xs < w) & (ys >= 0) & (ys < h))
+        # Only the biggest spots are worth refining
+        areas = stats[on_canvas, cv2.CC_STAT_AREA]
+        best = on_canvas[np.argsort(-areas, kind="stable")][:MAX_CANDIDATES]
+
+        centers = np.float64([self._refine(img, stats[i], centroids[i]) for i in best])
+        return canvas_mapping.to_canvas_points(centers.reshape(-1, 2) + offset)
+
+    def find_marker_position(
+        self,
+        img,
+        last_pos: Optional[Point],
+        canvas_mapping: CanvasMapping,
+        search_rect: Optional[Rectangle] = None,
+        timestamp: Optional[float] = None,
+        display_mask=None,
+    ) -> Optional[Point]:
+        img, offset = self._crop(img, search_rect)
+        stats, centroids = self._components(img, offset, timestamp, display_mask)
+        if not len(stats):
+            return None
+
+        best = self._best_candidate(stats, centroids, last_pos, canvas_mapping, offset)
+        if best is None:
+            return None
+        cx, cy = self._refine(img, stats[best], centroids[best])
+        return canvas_mapping.to_canvas(cx + offset[0], cy + offset[1])
+
+    def _best_candidate(
+        self,
+        stats,
+        centroids,
+        last_pos: Optional[Point],
+        canvas_mapping: CanvasMapping,
+        offset: Tuple[int, int],
+    ) -> Optional[int]:
+        full_res = self._to_full_res(centroids)
+        xs, ys = canvas_mapping.to_canvas_xy(
+            full_res[:, 0] + offset[0], full_res[:, 1] + offset[1]
+        )
+        h, w = canvas_mapping.canvas_size
+        on_canvas = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        if not on_canvas.any():
+            return None
+
+        if not last_pos:
+            # Without any history, the biggest spot is our best guess
+            score = -stats[:, cv2.CC_STAT_AREA].astype(np.float64)
+        else:
+            score = (xs - last_pos.x) ** 2 + (ys - last_pos.y) ** 2
+        score[~on_canvas] = np.inf
+        return int(np.argmin(score))
+
+    def _to_full_res(self, small_coords):
+        # Each small pixel covers scale x scale full resolution pixels
+        return (small_coords + 0.5) * self.scale - 0.5
+
+    def _weighted_center(self, patch) -> Optional[Tuple[float, float]]:
+        # Intensity weighted centre of the filtered patch, for sub pixel accuracy
+        filtered = self.filter_red(patch)
+        cv2.threshold(
+            filtered, MIN_VISIBLE_THRESH, 255, cv2.THRESH_TOZERO, dst=filtered
+        )
+        m = cv2.moments(filtered)
+        if m["m00"] == 0:
+            return None
+        return m["m10"] / m["m00"], m["m01"] / m["m00"]
+
+
+DETECTORS = {
+    "contours": MarkerDetector,
+    "pyramid": PyramidMarkerDetector,
+}
+DEFAULT_DETECTOR = "contours"
+
+
+def create_detector(name: str = DEFAULT_DETECTOR, **options) -> MarkerDetector:
+    return DETECTORS[name](**options)
+
+
+# Size of the made up frame that workers warm up on
+WARM_UP_FRAME_SIZE = (480, 640)
+
+
+def warm_up_detector(
+    detector_name: str = DEFAULT_DETECTOR,
+    detector_options: Optional[Dict[str, Any]] = None,
+):
+    """Runs a throwaway detector on a made up frame, so that the first real
+    frames don't pay for OpenCV's lazy initialization."""
+    h, w = WARM_UP_FRAME_SIZE
+    img = np.zeros((h, w, 3), np.uint8)
+    cv2.circle(img, (w // 2, h // 2), 4, (80, 80, 255), cv2.FILLED)
+    detector = create_detector(detector_name, **(detector_options or {}))
+    detector.find_marker_position(
+        img, None, CanvasMapping(np.eye(3), (h, w)), None, time.perf_counter()
+    )
+
+
+# Each pool worker keeps its own detector (and buffers) for the whole session
+gWorkerDetector: Optional[MarkerDetector] = None
+# Shared frame rings by name, attached when first used
+gWorkerRings: Dict[str, SharedFrameRing] = {}
+
+
+def init_detector_worker(
+    detector_name: str = DEFAULT_DETECTOR,
+    detector_options: Optional[Dict[str, Any]] = None,
+):
+    global gWorkerDetector
+    warm_up_detector(detector_name, detector_options)
+    gWorkerDetector = create_detector(detector_name, **(detector_options or {}))
+
+
+def start_detector_pool(
+    detector_name: str = DEFAULT_DETECTOR,
+    detector_options: Optional[Dict[str, Any]] = None,
+    processes: Optional[int] = None,
+) -> Pool:
+    """Starts detection workers, which warm up in the background. They don't
+    depend on any camera, so they can be started before the cameras are."""
+    if os.name == "posix":
+        # Workers share our tracker of shared memory, rather than each starting
+        # one of their own that would unlink the frame rings when they exit.
+        # Elsewhere shared memory isn't tracked (and the tracker can't start).
+        from multiprocessing import resource_tracker
+
+        resource_tracker.ensure_running()
+    return Pool(
+        processes,
+        initializer=init_detector_worker,
+        initargs=(detector_name, detector_options),
+    )
+
+
+# A shared frame ring and the slot and seq of a frame in it
+SlotRef = Tuple[FrameRingSpec, int, int]
+# Frame, last position, mapping, search rect, capture time, and the display
+# mask (if any)
+SlotDetectionArgs = Tuple[
+    SlotRef,
+    Optional[Point],
+    CanvasMapping,
+    Optional[Rectangle],
+    float,
+    Optional[SlotRef],
+]
+
+
+def _read_slot(ref: SlotRef):
+    spec, slot, seq = ref
+    ring = gWorkerRings.get(spec[0])
+    if ring is None:
+        ring = gWorkerRings[spec[0]] = SharedFrameRing.attach(spec)
+    return ring.read(slot, seq)
+
+
+def detect_marker_in_slot_t(
+    args: SlotDetectionArgs,
+):
+    frame_ref, last_pos, canvas_mapping, search_rect, timestamp, mask_ref = args
+    assert gWorkerDetector is not None
+    img = _read_slot(frame_ref)
+    display_mask = _read_slot(mask_ref) if mask_ref else None
+    if img is None:
+        return None
+    return gWorkerDetector.find_marker_position(
+        img, last_pos, canvas_mapping, search_rect, timestamp, display_mask
+    )
+
+
+def detect_candidates_in_slot_t(
+    args: SlotDetectionArgs,
+):
+    """Same arguments as detect_marker_in_slot_t, but returns all candidates."""
+    frame_ref, _, canvas_mapping, search_rect, timestamp, mask_ref = args
+    assert gWorkerDetector is not None
+    img = _read_slot(frame_ref)
+    display_mask = _read_slot(mask_ref) if mask_ref else None
+    if img is None:
+        return np.empty((0, 2))
+    return gWorkerDetector.find_marker_candidates(
+        img, canvas_mapping, search_rect, timestamp, display_mask
+    )
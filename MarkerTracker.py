@@ -0,0 +1,89 @@
+from typing import Optional
+from Shapes import Point, Rectangle
+from CanvasMapping import CanvasMapping
+
+
+# Search window half-size (in camera pixels) when the marker is standing still
+MIN_SEARCH_RADIUS = 40
+# How many ticks of movement the search window should cover
+VELOCITY_MARGIN = 2.0
+# Consecutive misses before we give up and go back to full frame search
+MAX_LOST_FRAMES = 5
+# Don't bother with a window that covers most of the frame anyway
+MAX_WINDOW_FRACTION = 0.5
+
+
+class MarkerTracker:
+    """Keeps a search window around the last known marker position.
+
+    Positions are in canvas space, windows are in camera frame space, and are
+    limited to the given frame bounds.
+    """
+
+    def __init__(
+        self,
+        frame_bounds: Rectangle,
+        canvas_mapping: CanvasMapping,
+        min_search_radius: int = MIN_SEARCH_RADIUS,
+        max_lost_frames: int = MAX_LOST_FRAMES,
+    ):
+        self.frame_bounds = frame_bounds
+        self.canvas_mapping = canvas_mapping
+        self.min_search_radius = min_search_radius
+        self.max_lost_frames = max_lost_frames
+        self.reset()
+
+    def reset(self):
+        self.last_pos: Optional[Point] = None
+        # Last position and velocity (per tick) in camera frame space
+        self.last_frame_pos = (0.0, 0.0)
+        self.velocity = (0.0, 0.0)
+        self.lost_cnt = 0
+
+    def search_rect(self) -> Optional[Rectangle]:
+        if self.last_pos is None:
+            return None
+
+        vx, vy = self.velocity
+
+        # Predict where the marker is now, and widen the window the longer we
+        # have been missing it
+        ticks = self.lost_cnt + 1
+        cx = self.last_frame_pos[0] + vx * ticks
+        cy = self.last_frame_pos[1] + vy * ticks
+        radius = self.min_search_radius + VELOCITY_MARGIN * ticks * max(
+            abs(vx), abs(vy)
+        )
+
+        bounds = self.frame_bounds
+        left_x = max(bounds.left_x(), int(cx - radius))
+        right_x = min(bounds.right_x(), int(cx + radius))
+        bottom_y = max(bounds.bottom_y(), int(cy - radius))
+        top_y = min(bounds.top_y(), int(cy + radius))
+
+        if right_x <= left_x or top_y <= bottom_y:
+            return None
+
+        window_area = (right_x - left_x) * (top_y - bottom_y)
+        if window_area > bounds.width() * bounds.height() * MAX_WINDOW_FRACTION:
+            return None
+
+        return Rectangle(Point(left_x, bottom_y), Point(right_x, top_y))
+
+    def update(self, marker_pos: Optional[Point]):
+        if marker_pos is None:
+            self.lost_cnt += 1
+            if self.lost_cnt > self.max_lost_frames:
+                self.reset()
+            return
+
+        frame_pos = self.canvas_mapping.to_frame(marker_pos)
+        if self.last_pos is not None:
+            ticks = self.lost_cnt + 1
+            self.velocity = (
+                (frame_pos[0] - self.last_frame_pos[0]) / ticks,
+                (frame_pos[1] - self.last_frame_pos[1]) / ticks,
+            )
+        self.last_pos = marker_pos
+        self.last_frame_pos = frame_pos
+        self.lost_cnt = 0
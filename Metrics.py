@@ -0,0 +1,168 @@
+import csv
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+# Log bucketed histograms: every power of two is split into SUB_BUCKETS
+# linear buckets, so each bucket is within 1/SUB_BUCKETS of its value.
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Anything longer than 2^MAX_BITS ns (~137 seconds) goes to the last bucket
+MAX_BITS = 37
+NUM_BUCKETS = SUB_BUCKETS + (MAX_BITS - SUB_BUCKET_BITS) * SUB_BUCKETS
+
+CSV_FIELDS = [
+    "thread",
+    "stage",
+    "count",
+    "mean_ms",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "max_ms",
+]
+
+
+def bucket_index(ns: int) -> int:
+    if ns < SUB_BUCKETS:
+        return max(ns, 0)
+    exp = ns.bit_length() - SUB_BUCKET_BITS - 1
+    mantissa = (ns >> exp) - SUB_BUCKETS
+    return min(SUB_BUCKETS + exp * SUB_BUCKETS + mantissa, NUM_BUCKETS - 1)
+
+
+def bucket_upper_ns(idx: int) -> int:
+    """The (exclusive) upper bound of a bucket."""
+    if idx < SUB_BUCKETS:
+        return idx + 1
+    exp, mantissa = divmod(idx - SUB_BUCKETS, SUB_BUCKETS)
+    return (SUB_BUCKETS + mantissa + 1) << exp
+
+
+class LatencyHistogram:
+    """Fixed size, allocation free, histogram of durations in nanoseconds."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns: int):
+        self.counts[bucket_index(ns)] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def percentile_ns(self, percentile: float) -> int:
+        if not self.count:
+            return 0
+        target = self.count * percentile / 100.0
+        seen = 0
+        for idx, cnt in enumerate(self.counts):
+            seen += cnt
+            if cnt and seen >= target:
+                return min(bucket_upper_ns(idx), self.max_ns)
+        return self.max_ns
+
+    def mean_ns(self) -> float:
+        return self.total_ns / self.count if self.count else 0.0
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_ms": self.mean_ns() / 1e6,
+            "p50_ms": self.percentile_ns(50) / 1e6,
+            "p95_ms": self.percentile_ns(95) / 1e6,
+            "p99_ms": self.percentile_ns(99) / 1e6,
+            "max_ms": self.max_ns / 1e6,
+        }
+
+
+class Metrics:
+    """Latency histograms per thread and stage.
+
+    Every thread only ever records into its own histograms, so recording
+    needs no locks. Snapshots are taken without stopping the recording
+    threads, so they may be a sample or two off.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self.local = threading.local()
+
+    def histogram(self, stage: str) -> LatencyHistogram:
+        """The calling thread's histogram for the given stage."""
+        thread_histograms = getattr(self.local, "histograms", None)
+        if thread_histograms is None:
+            thread_histograms = self.local.histograms = {}
+
+        histogram = thread_histograms.get(stage)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            thread_histograms[stage] = histogram
+            with self.lock:
+                self.histograms[(threading.current_thread().name, stage)] = histogram
+        return histogram
+
+    def record(self, stage: str, ns: int):
+        self.histogram(stage).record(ns)
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        with self.lock:
+            items = list(self.histograms.items())
+
+        snapshot: Dict[str, Dict[str, Dict[str, float]]] = {}
+        for (thread_name, stage), histogram in items:
+            snapshot.setdefault(thread_name, {})[stage] = histogram.summary()
+        return snapshot
+
+    def reset(self):
+        with self.lock:
+            for histogram in self.histograms.values():
+                histogram.reset()
+
+    def rows(self) -> List[Dict]:
+        return [
+            {"thread": thread_name, "stage": stage, **summary}
+            for thread_name, stages in self.snapshot().items()
+            for stage, summary in stages.items()
+        ]
+
+    def export_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def export_csv(self, path: str):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.rows())
+
+    def export(self, path: str):
+        if path.endswith(".csv"):
+            self.export_csv(path)
+        else:
+            self.export_json(path)
+
+    def summary_lines(self, thread_name: Optional[str] = None) -> List[str]:
+        lines = []
+        for row in self.rows():
+            if thread_name and row["thread"] != thread_name:
+                continue
+            lines.append(
+                f"{row['thread']} / {row['stage']}: "
+                f"p50 {row['p50_ms']:.1f}ms p95 {row['p95_ms']:.1f}ms "
+                f"p99 {row['p99_ms']:.1f}ms (n={row['count']})"
+            )
+        return lines
+
+
+# The process wide metrics everything records into
+gMetrics = Metrics()
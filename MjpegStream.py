@@ -0,0 +1,158 @@
+import cv2
+import time
+import socket
+import select
+import numpy as np
+from typing import List, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+# How long to wait for data before giving up on a read
+READ_TIMEOUT_SEC = 2.0
+RECV_SIZE = 64 * 1024
+# Don't hammer a camera that is gone
+RECONNECT_DELAY_SEC = 0.5
+
+# cv2.imdecode flags for each supported downscale factor
+DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def is_mjpeg_url(video_url: Optional[str]) -> bool:
+    return bool(video_url) and urlsplit(video_url).scheme == "http"
+
+
+def parse_parts(buf: bytearray, boundary: bytes) -> Tuple[List[bytes], int]:
+    """Finds the complete parts of a multipart stream in buf.
+
+    Returns their bodies, oldest first, and how many bytes of buf they used.
+    """
+    parts = []
+    pos = 0
+    while True:
+        start = buf.find(boundary, pos)
+        if start < 0:
+            break
+        headers_end = buf.find(b"\r\n\r\n", start)
+        if headers_end < 0:
+            break
+        body_start = headers_end + 4
+
+        length = None
+        for line in bytes(buf[start:headers_end]).split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = int(value)
+        if length is not None:
+            body_end = body_start + length
+            if body_end > len(buf):
+                break
+        else:
+            # No length given, the part ends where the next one starts
+            body_end = buf.find(boundary, body_start)
+            if body_end < 0:
+                break
+            # The boundary delimiter starts on its own line
+            body_end = buf.rfind(b"\r\n", body_start, body_end)
+            if body_end < 0:
+                break
+
+        parts.append(bytes(buf[body_start:body_end]))
+        pos = body_end
+    return parts, pos
+
+
+class MjpegStream:
+    """Reads an MJPEG over HTTP stream, like cv2.VideoCapture would.
+
+    Only the newest complete frame on the socket is decoded, older ones are
+    already superseded and are skipped. With decode_scale > 1 frames are
+    decoded straight to a lower resolution, which is a lot cheaper.
+    """
+
+    def __init__(self, video_url: str, decode_scale: int = 1):
+        self.url = urlsplit(video_url)
+        self.decode_flags = DECODE_FLAGS[decode_scale]
+        self.sock: Optional[socket.socket] = None
+        self.boundary = b""
+        self.buf = bytearray()
+        # Frames we received but never decoded
+        self.dropped = 0
+        self.connect()
+
+    def connect(self):
+        host = self.url.hostname or "localhost"
+        self.sock = socket.create_connection(
+            (host, self.url.port or 80), timeout=READ_TIMEOUT_SEC
+        )
+        path = self.url.path or "/"
+        if self.url.query:
+            path += "?" + self.url.query
+        self.sock.sendall(f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+
+        self.buf = bytearray()
+        while b"\r\n\r\n" not in self.buf:
+            self.recv()
+        headers_end = self.buf.find(b"\r\n\r\n")
+        status, *headers = bytes(self.buf[:headers_end]).decode("latin-1").split("\r\n")
+        del self.buf[: headers_end + 4]
+        if status.split()[1:2] != ["200"]:
+            self.release()
+            raise ValueError(f"{self.url.geturl()}: {status}")
+
+        content_type = ""
+        for header in headers:
+            name, _, value = header.partition(":")
+            if name.strip().lower() == "content-type":
+                content_type = value
+        mime_type, _, params = content_type.partition(";")
+        _, _, boundary = params.partition("boundary=")
+        if mime_type.strip().lower() != "multipart/x-mixed-replace" or not boundary:
+            self.release()
+            raise ValueError(f"{self.url.geturl()} is not an MJPEG stream")
+        # Some servers already include the leading dashes, and some don't
+        self.boundary = b"--" + boundary.strip().strip('"').lstrip("-").encode()
+
+    def recv(self):
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            raise ConnectionError("Stream closed")
+        self.buf += data
+
+    def read_newest_part(self) -> bytes:
+        assert self.sock is not None
+        while True:
+            # Take everything that has already arrived, without waiting
+            while select.select([self.sock], [], [], 0)[0]:
+                self.recv()
+            parts, used = parse_parts(self.buf, self.boundary)
+            del self.buf[:used]
+            if parts:
+                self.dropped += len(parts) - 1
+                return parts[-1]
+            self.recv()
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        if self.sock is None:
+            # Reconnect after the stream was lost
+            try:
+                self.connect()
+            except (OSError, ValueError):
+                time.sleep(RECONNECT_DELAY_SEC)
+                return False, None
+        try:
+            part = self.read_newest_part()
+        except (OSError, ValueError):
+            self.release()
+            return False, None
+        frame = cv2.imdecode(np.frombuffer(part, np.uint8), self.decode_flags)
+        return frame is not None, frame
+
+    def release(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,91 @@
+import math
+from typing import Optional
+from Shapes import Point
+
+
+# One euro filter defaults, for canvas pixel positions and seconds
+MIN_CUTOFF_HZ = 1.0
+BETA = 0.007
+DERIVATIVE_CUTOFF_HZ = 1.0
+# Never extrapolate further than this, a wrong guess is worse than a late one
+MAX_LEAD_SEC = 0.1
+# Timestamps of frames can be (almost) equal, e.g. frames read in a burst
+MIN_DT_SEC = 0.001
+
+
+def smoothing_factor(dt: float, cutoff_hz: float) -> float:
+    tau = 1.0 / (2 * math.pi * cutoff_hz)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class OneEuroFilter:
+    """Low pass filter that follows faster the faster the value changes.
+
+    See https://gery.casiez.net/1euro/
+    """
+
+    def __init__(
+        self,
+        min_cutoff_hz: float = MIN_CUTOFF_HZ,
+        beta: float = BETA,
+        derivative_cutoff_hz: float = DERIVATIVE_CUTOFF_HZ,
+    ):
+        self.min_cutoff_hz = min_cutoff_hz
+        self.beta = beta
+        self.derivative_cutoff_hz = derivative_cutoff_hz
+        self.value: Optional[float] = None
+        self.derivative = 0.0
+
+    def update(self, value: float, dt: float) -> float:
+        if self.value is None:
+            self.value = value
+            self.derivative = 0.0
+            return value
+
+        derivative = (value - self.value) / dt
+        a = smoothing_factor(dt, self.derivative_cutoff_hz)
+        self.derivative += a * (derivative - self.derivative)
+
+        cutoff_hz = self.min_cutoff_hz + self.beta * abs(self.derivative)
+        a = smoothing_factor(dt, cutoff_hz)
+        self.value += a * (value - self.value)
+        return self.value
+
+
+class MotionPredictor:
+    """Smooths marker positions, and extrapolates where the marker is now.
+
+    Positions are in canvas space, timestamps are time.perf_counter() of when
+    the frame they were found in was captured.
+    """
+
+    def __init__(self, max_lead_sec: float = MAX_LEAD_SEC, **filter_options):
+        self.max_lead_sec = max_lead_sec
+        self.filter_options = filter_options
+        self.reset()
+
+    def reset(self):
+        self.x_filter = OneEuroFilter(**self.filter_options)
+        self.y_filter = OneEuroFilter(**self.filter_options)
+        self.last_timestamp: Optional[float] = None
+
+    def update(self, pos: Point, timestamp: float) -> Point:
+        """Feeds a detected position, and returns the smoothed one."""
+        dt = MIN_DT_SEC
+        if self.last_timestamp is not None:
+            dt = max(timestamp - self.last_timestamp, MIN_DT_SEC)
+        self.last_timestamp = timestamp
+
+        x = self.x_filter.update(pos.x, dt)
+        y = self.y_filter.update(pos.y, dt)
+        return Point(int(round(x)), int(round(y)))
+
+    def predict(self, timestamp: float) -> Optional[Point]:
+        """Where the marker will be at the given time, if we are tracking it."""
+        if self.last_timestamp is None:
+            return None
+
+        lead = min(max(timestamp - self.last_timestamp, 0.0), self.max_lead_sec)
+        x = self.x_filter.value + self.x_filter.derivative * lead
+        y = self.y_filter.value + self.y_filter.derivative * lead
+        return Point(int(round(x)), int(round(y)))
@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+from typing import Optional, Tuple
+from Shapes import Point, Rectangle
+
+
+# Anything lit for longer than this is considered part of the background
+STATIC_HOLD_SEC = 3.0
+# Pixels are tracked in cells of CELL_SIZE x CELL_SIZE
+CELL_SIZE = 8
+# Static things flicker at their edges, so their neighbouring cells go too
+STATIC_DILATE_KERNEL = np.ones((3, 3), np.uint8)
+
+
+class PersistenceMask:
+    """Masks out pixels that have been lit for longer than hold_sec.
+
+    Static red things (signs, posters, glare spots) stay lit, while the laser
+    dot keeps moving, so only transient spots are left in the image.
+    For every cell we keep since when it has been continuously lit. Cells that
+    are outside of the images we get (e.g. when searching a small window)
+    simply keep their state.
+    """
+
+    def __init__(self, hold_sec: float = STATIC_HOLD_SEC, cell_size: int = CELL_SIZE):
+        self.hold_sec = hold_sec
+        self.cell_size = cell_size
+        self.lit_since = np.full((0, 0), np.inf)
+
+    def _ensure_size(self, rows: int, cols: int):
+        h, w = self.lit_since.shape
+        if rows <= h and cols <= w:
+            return
+
+        grown = np.full((max(rows, h), max(cols, w)), np.inf)
+        grown[:h, :w] = self.lit_since
+        self.lit_since = grown
+
+    def align(self, search_rect: Optional[Rectangle]) -> Optional[Rectangle]:
+        """Grows the search rect so that it starts on a cell boundary."""
+        if not search_rect:
+            return search_rect
+
+        cell = self.cell_size
+        return Rectangle(
+            Point(
+                search_rect.left_x() // cell * cell,
+                search_rect.bottom_y() // cell * cell,
+            ),
+            search_rect.top_right,
+        )
+
+    def apply(self, thresh, offset: Tuple[int, int], timestamp: float):
+        """Updates the model with a binary image, and clears its static pixels.
+
+        offset is where thresh starts, and must be on a cell boundary.
+        """
+        cell = self.cell_size
+        rows, cols = thresh.shape[0] // cell, thresh.shape[1] // cell
+        if rows == 0 or cols == 0:
+            return
+
+        row0, col0 = offset[1] // cell, offset[0] // cell
+        self._ensure_size(row0 + rows, col0 + cols)
+        lit_since = self.lit_since[row0 : row0 + rows, col0 : col0 + cols]
+        # Partial cells at the far edges are never masked
+        region = thresh[: rows * cell, : cols * cell]
+
+        # With an integer ratio INTER_AREA is the mean of each cell, so any lit
+        # pixel makes it non zero
+        lit = cv2.resize(region, (cols, rows), interpolation=cv2.INTER_AREA) > 0
+        lit_since[~lit] = np.inf
+        np.minimum(lit_since, timestamp, out=lit_since, where=lit)
+
+        static = (timestamp - lit_since) >= self.hold_sec
+        if not static.any():
+            return
+
+        static = cv2.dilate(static.view(np.uint8), STATIC_DILATE_KERNEL)
+        static_pixels = cv2.resize(
+            static * np.uint8(255),
+            (cols * cell, rows * cell),
+            interpolation=cv2.INTER_NEAREST,
+        )
+        cv2.bitwise_and(region, cv2.bitwise_not(static_pixels), dst=region)
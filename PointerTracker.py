@@ -0,0 +1,87 @@
+import numpy as np
+from typing import Callable, List, Optional, Tuple
+from Shapes import Point
+from StrokeHistory import Stroke
+
+
+# How far (in canvas pixels) a pointer can move between two frames
+MAX_TRACK_JUMP = 250
+# Frames without a position before a pointer is considered gone
+MAX_TRACK_LOST_FRAMES = 10
+
+
+class PointerTrack:
+    """A single pointer, and the state of the stroke it is drawing."""
+
+    def __init__(self, slot: int, color: Tuple[int, int, int], radius: int):
+        self.slot = slot
+        self.color = color
+        self.radius = radius
+        self.last_dot: Optional[Point] = None
+        self.stroke: Optional[Stroke] = None
+        self.clear_cnt = 0
+        self.lost_cnt = 0
+        # Where it was last seen, and the positions that weren't drawn yet
+        self.position = np.zeros(2)
+        self.new_positions: List[Point] = []
+
+    def add(self, position):
+        self.position = position
+        self.new_positions.append(Point(int(position[0]), int(position[1])))
+        self.lost_cnt = 0
+
+
+class PointerTracker:
+    """Assigns the marker candidates of every frame to up to max_tracks
+    pointers.
+
+    Candidates are matched to the nearest tracks, closest pairs first. The
+    ones left over start new tracks, while there are free slots.
+    """
+
+    def __init__(
+        self,
+        max_tracks: int,
+        new_track: Callable[[int], PointerTrack],
+        max_jump: float = MAX_TRACK_JUMP,
+        max_lost_frames: int = MAX_TRACK_LOST_FRAMES,
+    ):
+        self.slots: List[Optional[PointerTrack]] = [None] * max_tracks
+        self.new_track = new_track
+        self.max_jump_sq = max_jump * max_jump
+        self.max_lost_frames = max_lost_frames
+
+    def tracks(self) -> List[PointerTrack]:
+        return [track for track in self.slots if track]
+
+    def reset(self):
+        self.slots = [None] * len(self.slots)
+
+    def update(self, candidates: np.ndarray):
+        """Feeds the N x 2 candidate positions of one frame."""
+        tracks = self.tracks()
+        track_taken = np.zeros(len(tracks), bool)
+        candidate_taken = np.zeros(len(candidates), bool)
+
+        if tracks and len(candidates):
+            positions = np.array([track.position for track in tracks])
+            dist_sq = ((positions[:, None, :] - candidates[None, :, :]) ** 2).sum(2)
+            order = np.argsort(dist_sq, axis=None)
+            order = order[dist_sq.flat[order] <= self.max_jump_sq]
+            # Only len(tracks) * len(candidates) pairs, all of them close enough
+            for t, c in zip(*np.unravel_index(order, dist_sq.shape)):
+                if track_taken[t] or candidate_taken[c]:
+                    continue
+                tracks[t].add(candidates[c])
+                track_taken[t] = candidate_taken[c] = True
+
+        for track in (t for t, taken in zip(tracks, track_taken) if not taken):
+            track.lost_cnt += 1
+            if track.lost_cnt > self.max_lost_frames and not track.new_positions:
+                self.slots[track.slot] = None
+
+        free_slots = [i for i, track in enumerate(self.slots) if track is None]
+        for candidate, slot in zip(candidates[~candidate_taken], free_slots):
+            track = self.new_track(slot)
+            track.add(candidate)
+            self.slots[slot] = track
@@ -0,0 +1,297 @@
+"""Renders a session log (see Graffiti.py --session_log) into a time-lapse.
+
+The output is a video, or a directory of PNG frames. Frames are rendered by a
+pool of processes, each replaying the log from the last clear before its
+frames (or from the start).
+
+Example usage:
+$ python RenderSession.py --log=session.log --out=timelapse.mp4 --size=1280x720
+"""
+
+
+import os
+import cv2
+import argparse
+import tempfile
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from typing import List, Optional, Tuple
+from SessionLog import (
+    SessionLogReader,
+    EVENT_SEGMENT,
+    EVENT_STROKE_END,
+    EVENT_CLEAR,
+    EVENT_UNDO,
+    EVENT_REDO,
+    EVENT_DISCARD,
+)
+from StrokeHistory import StrokeHistory
+from TiledCanvas import TiledCanvas
+
+
+# Output file extension -> fourcc
+VIDEO_CODECS = {
+    ".mp4": "mp4v",
+    ".avi": "MJPG",
+    ".mkv": "MJPG",
+}
+
+parser = argparse.ArgumentParser(description="Laser Graffiti time-lapse renderer")
+
+parser.add_argument(
+    "--log",
+    required=True,
+    type=str,
+    help="Session log to render",
+)
+
+parser.add_argument(
+    "--out",
+    required=True,
+    type=str,
+    help="Video file (" + ", ".join(VIDEO_CODECS) + ") or directory for PNG frames",
+)
+
+parser.add_argument(
+    "--size",
+    default=None,
+    type=str,
+    help="WxH of the output (the session's canvas size if not given)",
+)
+
+parser.add_argument(
+    "--duration",
+    default=30.0,
+    type=float,
+    help="Length of the time-lapse in seconds",
+)
+
+parser.add_argument(
+    "--fps",
+    default=30,
+    type=int,
+    help="Frames per second of the time-lapse",
+)
+
+parser.add_argument(
+    "--processes",
+    default=None,
+    type=int,
+    help="Number of render processes (all cores if not given)",
+)
+
+# (first record to replay, first frame, frame count)
+RenderJob = Tuple[int, int, int]
+
+
+class SessionReplay:
+    """Replays log records onto a canvas of any size."""
+
+    def __init__(
+        self,
+        canvas_size: Tuple[int, int],
+        out_size: Tuple[int, int],
+        history_size: int,
+    ):
+        h, w = canvas_size
+        out_w, out_h = out_size
+        self.out_size = out_size
+        self.scale = np.float32([out_w / w, out_h / h])
+        self.radius_scale = float(np.sqrt(self.scale.prod()))
+        self.history_size = history_size
+        self.clear()
+
+    def clear(self):
+        out_w, out_h = self.out_size
+        self.canvas = TiledCanvas((out_h, out_w, 3))
+        self.history = StrokeHistory(self.canvas, self.history_size)
+
+    def _draw(self, records: np.ndarray):
+        """Draws segments that share a color, radius and tick at once, like the
+        game did. Segments that continue each other are joined back into
+        polylines, which OpenCV draws a bit differently at the joints."""
+        segments = np.int32(np.round(records["points"] * self.scale))
+        splits = (
+            np.flatnonzero(
+                (records["points"][1:, 0] != records["points"][:-1, 1]).any(axis=1)
+            )
+            + 1
+        )
+        polylines = [
+            np.concatenate([run[:, 0], run[-1:, 1]])
+            for run in np.split(segments, splits)
+        ]
+        radius = max(1, int(round(records["radius"][0] * self.radius_scale)))
+        self.history.begin()
+        self.canvas.polylines(
+            polylines, tuple(int(c) for c in records["color"][0]), radius
+        )
+
+    def apply(self, records: np.ndarray):
+        kinds = records["kind"]
+        segments = kinds == EVENT_SEGMENT
+        # Where a run of segments that can be drawn together ends
+        run_break = np.ones(len(records), bool)
+        run_break[:-1] = (
+            ~segments[1:]
+            | (records["time"][1:] != records["time"][:-1])
+            | (records["radius"][1:] != records["radius"][:-1])
+            | (records["color"][1:] != records["color"][:-1]).any(axis=1)
+        )
+
+        start = 0
+        for end in (np.flatnonzero(run_break) + 1).tolist():
+            kind = kinds[start]
+            if kind == EVENT_SEGMENT:
+                self._draw(records[start:end])
+            elif kind == EVENT_STROKE_END:
+                self.history.end()
+            elif kind == EVENT_CLEAR:
+                self.clear()
+            elif kind == EVENT_UNDO:
+                self.history.undo()
+            elif kind == EVENT_REDO:
+                self.history.redo()
+            elif kind == EVENT_DISCARD:
+                self.history.discard()
+            start = end
+
+
+def frame_record_ends(log: SessionLogReader, frame_cnt: int) -> np.ndarray:
+    """For every frame, how many records are shown by then. The session is
+    spread evenly over the frames, the last one shows all of it."""
+    times = log.records["time"]
+    end_time = times[-1] if len(times) else 0.0
+    frame_times = np.arange(1, frame_cnt + 1) * (end_time / frame_cnt)
+    ends = np.searchsorted(times, frame_times, side="right")
+    ends[-1] = len(times)
+    return ends
+
+
+def plan_jobs(
+    log: SessionLogReader, ends: np.ndarray, processes: int
+) -> List[RenderJob]:
+    """Splits the frames into jobs that each start from a clear (or the start
+    of the log), so nothing before it has to be replayed. Long stretches
+    without a clear are split further, replaying from the same clear."""
+    clears = np.flatnonzero(log.records["kind"] == EVENT_CLEAR)
+    # The last clear each frame has seen
+    checkpoints = np.searchsorted(clears, ends, side="left") - 1
+    max_job_frames = max(1, -(-len(ends) // processes))
+
+    jobs = []
+    first = 0
+    while first < len(ends):
+        last = first + 1
+        while (
+            last < len(ends)
+            and checkpoints[last] == checkpoints[first]
+            and last - first < max_job_frames
+        ):
+            last += 1
+        start = int(clears[checkpoints[first]]) if checkpoints[first] >= 0 else 0
+        jobs.append((start, first, last - first))
+        first = last
+    return jobs
+
+
+# Per worker process state
+gWorkerLog: Optional[SessionLogReader] = None
+gWorkerEnds: Optional[np.ndarray] = None
+gWorkerOutSize: Tuple[int, int] = (0, 0)
+gWorkerFramesDir = ""
+
+
+def init_render_worker(
+    log_path: str, ends: np.ndarray, out_size: Tuple[int, int], frames_dir: str
+):
+    global gWorkerLog, gWorkerEnds, gWorkerOutSize, gWorkerFramesDir
+    gWorkerLog = SessionLogReader(log_path)
+    gWorkerEnds = ends
+    gWorkerOutSize = out_size
+    gWorkerFramesDir = frames_dir
+
+
+def frame_path(frames_dir: str, i: int) -> str:
+    return os.path.join(frames_dir, f"frame_{i:06d}.png")
+
+
+def render_job(job: RenderJob) -> List[str]:
+    """Renders the job's frames to PNG files, returns their paths in order."""
+    assert gWorkerLog is not None and gWorkerEnds is not None
+    start, first, cnt = job
+    replay = SessionReplay(
+        gWorkerLog.canvas_size, gWorkerOutSize, gWorkerLog.history_size
+    )
+    paths = []
+    for i in range(first, first + cnt):
+        end = gWorkerEnds[i]
+        replay.apply(gWorkerLog.records[start:end])
+        start = end
+        path = frame_path(gWorkerFramesDir, i)
+        cv2.imwrite(path, replay.canvas.to_array())
+        paths.append(path)
+    return paths
+
+
+def render_session(
+    log_path: str,
+    out: str,
+    out_size: Optional[Tuple[int, int]] = None,
+    frame_cnt: int = 900,
+    fps: int = 30,
+    processes: Optional[int] = None,
+):
+    log = SessionLogReader(log_path)
+    h, w = log.canvas_size
+    out_size = out_size or (w, h)
+    processes = processes or cpu_count()
+    ends = frame_record_ends(log, frame_cnt)
+    jobs = plan_jobs(log, ends, processes)
+    log.close()
+
+    codec = VIDEO_CODECS.get(os.path.splitext(out)[1].lower())
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Video frames go through temporary PNGs, which are encoded in order
+        # while later frames are still being rendered
+        frames_dir = tmp_dir if codec else out
+        os.makedirs(frames_dir, exist_ok=True)
+        writer = (
+            cv2.VideoWriter(out, cv2.VideoWriter_fourcc(*codec), fps, out_size)
+            if codec
+            else None
+        )
+        with Pool(
+            processes,
+            initializer=init_render_worker,
+            initargs=(log_path, ends, out_size, frames_dir),
+        ) as pool:
+            for paths in pool.imap(render_job, jobs):
+                if not writer:
+                    continue
+                for path in paths:
+                    writer.write(cv2.imread(path))
+                    os.remove(path)
+        if writer:
+            writer.release()
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    w, h = size.lower().split("x")
+    return int(w), int(h)
+
+
+def main():
+    args = parser.parse_args()
+    render_session(
+        args.log,
+        args.out,
+        parse_size(args.size) if args.size else None,
+        max(1, int(args.duration * args.fps)),
+        args.fps,
+        args.processes,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,82 @@
 import os
 import cv2
+import json
+import time
 import ctypes
 import numpy as np
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Iterable, List, Dict, Union
 from ImageUtils import (
     has_min_size,
     filter_cyan,
 )
 from Colors import *
 from Shapes import Point, Rectangle
+from CanvasMapping import ScreenRegion
+from TiledCanvas import TiledCanvas
+from Widgets import WidgetLayer
 
 SQUARE_COLOR = CYAN
 
 MIN_SCREEN_AREA = 8000
 
+CALIBRATION_FILE = "calibration.json"
+CALIBRATION_ATTEMPTS = 5
+
+# Frame differencing is done on tiny grey thumbnails
+DIFF_THUMBNAIL_SIZE = (80, 60)
+# Mean abs difference (0-255) below which two frames are considered the same
+STABLE_DIFF = 2.0
+# ...and above which the camera has seen the screen change
+CHANGED_DIFF = 10.0
+STABLE_FRAMES = 3
+STABLE_TIMEOUT_SEC = 3.0
+
+# A saved screen quad is reused if the projected square still fills it, and
+# hardly spills out of it
+MIN_QUAD_FILL = 0.9
+MAX_QUAD_SPILL = 0.05
+
+OVERLAY_FONT_SCALE = 0.5
+OVERLAY_LINE_HEIGHT = 18
+OVERLAY_MARGIN = 6
+
 gScreenSize = None
 
+# Start, end, color and thickness of a line that is not (yet) on the canvas
+ProvisionalLine = Tuple[Point, Point, Tuple[int, int, int], int]
+
+
+class CvDisplay:
+    def show(self, img):
+        cv2.imshow("IMG", img)
+
+    def wait_key(self, wait_ms: int) -> int:
+        return cv2.waitKey(wait_ms)
+
+
+class NullDisplay:
+    """Shows nothing and never waits, for running without a GUI."""
+
+    def show(self, img):
+        pass
+
+    def wait_key(self, wait_ms: int) -> int:
+        return -1
+
+
+gDisplay = CvDisplay()
+
+
+def set_display(display, screen_size: Optional[Tuple[int, int]] = None):
+    global gDisplay, gScreenSize
+    gDisplay = display
+    if screen_size:
+        gScreenSize = screen_size
+
+
+def wait_key(wait_ms: int) -> int:
+    return gDisplay.wait_key(wait_ms)
+
 
 def get_screen_size() -> Tuple[int, int]:
     global gScreenSize
@@ -52,77 +113,448 @@ def show_image_fullscreen(img, mirror=False):
     # interpolation
     fs_img = cv2.resize(img, (0, 0), fx=wf, fy=hf, interpolation=cv2.INTER_NEAREST)
 
-    cv2.imshow("IMG", fs_img)
+    gDisplay.show(fs_img)
+
+
+class ScreenCompositor:
+    """Keeps a screen sized copy of the canvas, and only updates dirty parts.
+
+    Produces the same image as show_image_fullscreen.
+    """
+
+    def __init__(
+        self,
+        canvas_shape: Tuple[int, ...],
+        mirror: bool = False,
+        screen_size: Optional[Tuple[int, int]] = None,
+        widgets: Optional[WidgetLayer] = None,
+    ):
+        h, w = canvas_shape[:2]
+        sw, sh = screen_size or get_screen_size()
+        self.canvas_size = (h, w)
+        self.mirror = mirror
+        self.framebuffer = np.zeros((sh, sw) + tuple(canvas_shape[2:]), np.uint8)
+
+        # Same nearest neighbour mapping as cv2.resize with INTER_NEAREST
+        self.col_src = np.minimum(
+            np.floor(np.arange(sw) * (1 / (sw / float(w)))).astype(np.intp), w - 1
+        )
+        self.row_src = np.minimum(
+            np.floor(np.arange(sh) * (1 / (sh / float(h)))).astype(np.intp), h - 1
+        )
+        self.col_map = w - 1 - self.col_src if mirror else self.col_src
+
+        # Dense canvases (numpy arrays) are supported too
+        self.canvas: Optional[Union[TiledCanvas, np.ndarray]] = None
+        # Drawn straight onto the framebuffer, the screen areas they cover are
+        # redrawn from the canvas before they change
+        self.overlay_lines: Optional[List[str]] = None
+        self.provisional_line: Optional[ProvisionalLine] = None
+        self.overlay_boxes: List[Tuple[int, int, int, int]] = []
+        # Widgets are always on top of the canvas. Their sprites are scaled to
+        # the screen once, and drawn wherever the canvas under them is redrawn.
+        self.widgets = widgets
+        self.screen_sprites: Dict[Tuple[int, int], np.ndarray] = {}
+
+    def _screen_cols(self, left_x: int, right_x: int) -> Tuple[int, int]:
+        w = self.canvas_size[1]
+        if self.mirror:
+            left_x, right_x = w - right_x, w - left_x
+        return (
+            int(np.searchsorted(self.col_src, left_x)),
+            int(np.searchsorted(self.col_src, right_x)),
+        )
+
+    def _screen_rows(self, bottom_y: int, top_y: int) -> Tuple[int, int]:
+        return (
+            int(np.searchsorted(self.row_src, bottom_y)),
+            int(np.searchsorted(self.row_src, top_y)),
+        )
+
+    def _screen_box(self, rect: Rectangle) -> Tuple[int, int, int, int]:
+        h, w = self.canvas_size
+        sx0, sx1 = self._screen_cols(max(0, rect.left_x()), min(w, rect.right_x()))
+        sy0, sy1 = self._screen_rows(max(0, rect.bottom_y()), min(h, rect.top_y()))
+        return sx0, sy0, sx1, sy1
+
+    def _canvas_rect(self, sx0: int, sy0: int, sx1: int, sy1: int) -> Rectangle:
+        cols = self.col_map[sx0:sx1]
+        rows = self.row_src[sy0:sy1]
+        return Rectangle(
+            Point(int(cols.min()), int(rows[0])),
+            Point(int(cols.max()) + 1, int(rows[-1]) + 1),
+        )
+
+    def _screen_sprite(self, widget) -> np.ndarray:
+        sprite = widget.sprite()
+        key = (id(widget), id(sprite))
+        if key not in self.screen_sprites:
+            # Same nearest neighbour mapping as the canvas itself
+            sx0, sy0, sx1, sy1 = self._screen_box(widget.position)
+            self.screen_sprites[key] = sprite[
+                (self.row_src[sy0:sy1] - widget.position.bottom_y())[:, None],
+                self.col_map[sx0:sx1] - widget.position.left_x(),
+            ]
+        return self.screen_sprites[key]
+
+    def _draw_widget(self, widget, clip: Tuple[int, int, int, int]):
+        sx0, sy0, sx1, sy1 = self._screen_box(widget.position)
+        cx0, cy0 = max(sx0, clip[0]), max(sy0, clip[1])
+        cx1, cy1 = min(sx1, clip[2]), min(sy1, clip[3])
+        if cx0 >= cx1 or cy0 >= cy1:
+            return
+        self.framebuffer[cy0:cy1, cx0:cx1] = self._screen_sprite(widget)[
+            cy0 - sy0 : cy1 - sy0, cx0 - sx0 : cx1 - sx0
+        ]
+
+    def _sample(self, rows: np.ndarray, cols: np.ndarray, out: np.ndarray):
+        assert self.canvas is not None
+        if isinstance(self.canvas, TiledCanvas):
+            self.canvas.sample(rows, cols, out)
+        else:
+            out[:] = self.canvas[rows[:, None], cols]
+
+    def update(self, canvas, dirty_rects: Iterable[Optional[Rectangle]]) -> bool:
+        if canvas is not self.canvas:
+            # A new canvas (e.g. after clearing), redraw everything
+            self.canvas = canvas
+            self._redraw_screen_box(0, 0, *self.framebuffer.shape[1::-1])
+            return True
+
+        updated = False
+        for rect in dirty_rects:
+            if not rect:
+                continue
+
+            sx0, sy0, sx1, sy1 = self._screen_box(rect)
+            if sx0 >= sx1 or sy0 >= sy1:
+                continue
+
+            self._redraw_screen_box(sx0, sy0, sx1, sy1)
+            updated = True
+
+        return updated
+
+    def _redraw_screen_box(self, sx0: int, sy0: int, sx1: int, sy1: int):
+        self._sample(
+            self.row_src[sy0:sy1],
+            self.col_map[sx0:sx1],
+            self.framebuffer[sy0:sy1, sx0:sx1],
+        )
+        if self.widgets:
+            rect = self._canvas_rect(sx0, sy0, sx1, sy1)
+            for widget in self.widgets.widgets_in(rect):
+                self._draw_widget(widget, (sx0, sy0, sx1, sy1))
+
+    def _to_screen(self, p: Point) -> Tuple[int, int]:
+        sh, sw = self.framebuffer.shape[:2]
+        h, w = self.canvas_size
+        x = w - 1 - p.x if self.mirror else p.x
+        return int((x + 0.5) * sw / w), int((p.y + 0.5) * sh / h)
+
+    def _draw_provisional_line(self, line: ProvisionalLine):
+        start, end, color, thickness = line
+        sh, sw = self.framebuffer.shape[:2]
+        scale = sw / self.canvas_size[1]
+        screen_thickness = max(1, int(round(thickness * scale)))
+        (x0, y0), (x1, y1) = self._to_screen(start), self._to_screen(end)
+        cv2.line(
+            self.framebuffer,
+            (x0, y0),
+            (x1, y1),
+            color,
+            thickness=screen_thickness,
+            lineType=cv2.LINE_AA,
+        )
+        margin = screen_thickness // 2 + 2
+        self.overlay_boxes.append(
+            (
+                max(0, min(x0, x1) - margin),
+                max(0, min(y0, y1) - margin),
+                min(sw, max(x0, x1) + margin + 1),
+                min(sh, max(y0, y1) + margin + 1),
+            )
+        )
+
+    def _draw_text(self, lines: List[str]):
+        sh, sw = self.framebuffer.shape[:2]
+        text_w = max(
+            cv2.getTextSize(line, cv2.FONT_HERSHEY_SIMPLEX, OVERLAY_FONT_SCALE, 1)[0][0]
+            for line in lines
+        )
+        sx1 = min(sw, text_w + 2 * OVERLAY_MARGIN)
+        sy1 = min(sh, len(lines) * OVERLAY_LINE_HEIGHT + 2 * OVERLAY_MARGIN)
+        # Darken what's behind the text so it is readable on any drawing
+        self.framebuffer[:sy1, :sx1] >>= 2
+        for i, line in enumerate(lines):
+            cv2.putText(
+                self.framebuffer,
+                line,
+                (OVERLAY_MARGIN, OVERLAY_MARGIN + (i + 1) * OVERLAY_LINE_HEIGHT - 4),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                OVERLAY_FONT_SCALE,
+                WHITE,
+                1,
+                cv2.LINE_AA,
+            )
+        self.overlay_boxes.append((0, 0, sx1, sy1))
+
+    def _draw_overlays(self):
+        # Whatever was drawn last time goes away first
+        for box in self.overlay_boxes:
+            self._redraw_screen_box(*box)
+        self.overlay_boxes = []
+
+        if self.provisional_line:
+            self._draw_provisional_line(self.provisional_line)
+        if self.overlay_lines:
+            self._draw_text(self.overlay_lines)
+
+    def show(
+        self,
+        canvas,
+        dirty_rects: Iterable[Optional[Rectangle]],
+        overlay_lines: Optional[List[str]] = None,
+        provisional_line: Optional[ProvisionalLine] = None,
+    ):
+        """Shows the canvas, with things that are not part of it on top.
+
+        overlay_lines are text lines for the top left corner, provisional_line
+        is a line in canvas space that is only shown until the next call.
+        Overlays are only redrawn when they change, or when something was
+        drawn under them.
+        """
+        updated = self.update(canvas, dirty_rects)
+        if self.widgets:
+            sh, sw = self.framebuffer.shape[:2]
+            screen_box = (0, 0, sw, sh)
+            for widget in self.widgets.pop_changed():
+                self._draw_widget(widget, screen_box)
+                updated = True
+        if (
+            overlay_lines is not self.overlay_lines
+            or provisional_line is not self.provisional_line
+            or (updated and self.overlay_boxes)
+        ):
+            self.overlay_lines = overlay_lines
+            self.provisional_line = provisional_line
+            self._draw_overlays()
+            updated = True
+
+        if updated:
+            gDisplay.show(self.framebuffer)
+
+
+def order_quad(points) -> np.ndarray:
+    """Orders 4 points clockwise, starting from the top left one."""
+    pts = np.float32(points).reshape(4, 2)
+    sums = pts.sum(axis=1)
+    diffs = pts[:, 1] - pts[:, 0]
+    return np.float32(
+        [
+            pts[np.argmin(sums)],
+            pts[np.argmin(diffs)],
+            pts[np.argmax(sums)],
+            pts[np.argmax(diffs)],
+        ]
+    )
 
 
-def find_corners(filtered_img) -> Optional[Tuple[Point, Point]]:
+def quad_bounds(quad) -> Rectangle:
+    return Rectangle(
+        Point(int(np.floor(quad[:, 0].min())), int(np.floor(quad[:, 1].min()))),
+        Point(int(np.ceil(quad[:, 0].max())), int(np.ceil(quad[:, 1].max()))),
+    )
+
+
+def find_screen_quad(filtered_img, debug: bool = False) -> Optional[np.ndarray]:
     blurred = cv2.GaussianBlur(filtered_img, (5, 5), 0)
     thresh = cv2.threshold(blurred, 200, 255, cv2.THRESH_BINARY)[1]
     cnts, _ = cv2.findContours(
         thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
     )[-2:]
 
-    for c in cnts:
-        x, y, w, h = cv2.boundingRect(c)
-        # draw a rectangle to visualize the bounding rect
-        cv2.rectangle(thresh, (x, y), (x + w, y + h), RED, 2)
+    if debug:
+        for c in cnts:
+            x, y, w, h = cv2.boundingRect(c)
+            # draw a rectangle to visualize the bounding rect
+            cv2.rectangle(thresh, (x, y), (x + w, y + h), RED, 2)
 
-    show_image_fullscreen(thresh)
-    cv2.waitKey(500)
+        show_image_fullscreen(thresh)
+        wait_key(500)
 
     cnts = [c for c in cnts if has_min_size(c, MIN_SCREEN_AREA)]
 
     if len(cnts) != 1:
         return None
 
-    screen_rect = cnts[0]
+    screen_cnt = cnts[0]
 
-    ext_left = min(
-        tuple(screen_rect[screen_rect[:, :, 0].argmin()][0]),
-        tuple(screen_rect[screen_rect[:, :, 0].argmin()][0]),
-    )
-    ext_right = max(
-        tuple(screen_rect[screen_rect[:, :, 0].argmax()][0]),
-        tuple(screen_rect[screen_rect[:, :, 0].argmax()][0]),
-    )
-    ext_bottom = min(
-        tuple(screen_rect[screen_rect[:, :, 1].argmin()][0]),
-        tuple(screen_rect[screen_rect[:, :, 1].argmin()][0]),
-    )
-    ext_top = max(
-        tuple(screen_rect[screen_rect[:, :, 1].argmax()][0]),
-        tuple(screen_rect[screen_rect[:, :, 1].argmax()][0]),
-    )
+    # The screen is a quadrilateral (not necessarily a rectangle when the
+    # camera is at an angle)
+    peri = cv2.arcLength(screen_cnt, True)
+    approx = cv2.approxPolyDP(screen_cnt, 0.04 * peri, True)
+    if len(approx) != 4:
+        approx = cv2.boxPoints(cv2.minAreaRect(screen_cnt))
 
-    return Point(ext_left[0], ext_bottom[1]), Point(ext_right[0], ext_top[1])
+    return order_quad(approx)
 
 
-def calibrate_screen_bounds(cam) -> Optional[Rectangle]:
+def _diff_thumbnail(img):
+    grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(grey, DIFF_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def _mean_diff(a, b) -> float:
+    return float(cv2.absdiff(a, b).mean())
+
+
+def wait_for_stable_frame(
+    cam, reference=None, timeout: float = STABLE_TIMEOUT_SEC
+) -> np.ndarray:
+    """Waits until the camera image stops changing, and returns that frame.
+
+    If a reference thumbnail is given, we first wait for the image to differ
+    from it (i.e. for what we just showed to actually reach the camera).
+    """
+    deadline = time.perf_counter() + timeout
+    changed = reference is None
+    last_thumbnail = None
+    stable_cnt = 0
+    seq = -1
+    while time.perf_counter() < deadline:
+        # Let the window actually draw what we asked it to
+        wait_key(1)
+
+        frame = cam.read_next(seq, timeout=0.1)
+        if frame is None:
+            continue
+        seq = frame.seq
+
+        thumbnail = _diff_thumbnail(frame.img)
+        if not changed:
+            changed = _mean_diff(thumbnail, reference) > CHANGED_DIFF
+
+        if last_thumbnail is not None and (
+            _mean_diff(thumbnail, last_thumbnail) < STABLE_DIFF
+        ):
+            stable_cnt += 1
+        else:
+            stable_cnt = 0
+        last_thumbnail = thumbnail
+
+        if changed and stable_cnt >= STABLE_FRAMES:
+            return frame.img.copy()
+
+    return cam.read().copy()
+
+
+def calibration_key(cam, img) -> str:
+    h, w = img.shape[:2]
+    return f"{cam.source}@{w}x{h}"
+
+
+def load_calibration(key: str, path: str = CALIBRATION_FILE) -> Optional[np.ndarray]:
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if key not in saved:
+        return None
+    return np.float32(saved[key])
+
+
+def save_calibration(key: str, quad: np.ndarray, path: str = CALIBRATION_FILE):
+    saved = {}
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    saved[key] = quad.tolist()
+    with open(path, "w") as f:
+        json.dump(saved, f, indent=2)
+
+
+def validate_screen_quad(filtered_img, quad: np.ndarray) -> bool:
+    """Checks that the projected square is still where the quad says it is."""
+    thresh = cv2.threshold(filtered_img, 200, 255, cv2.THRESH_BINARY)[1]
+    quad_mask = np.zeros(thresh.shape, np.uint8)
+    cv2.fillConvexPoly(quad_mask, np.int32(np.round(quad)), 255)
+
+    quad_area = cv2.countNonZero(quad_mask)
+    if quad_area < MIN_SCREEN_AREA:
+        return False
+
+    inside = cv2.countNonZero(cv2.bitwise_and(thresh, quad_mask))
+    outside = cv2.countNonZero(thresh) - inside
+    return inside >= quad_area * MIN_QUAD_FILL and outside <= quad_area * MAX_QUAD_SPILL
+
+
+def calibrate_screen_quad(
+    cam,
+    calibration_path: str = CALIBRATION_FILE,
+    recalibrate: bool = False,
+    debug: bool = False,
+    region: Optional[ScreenRegion] = None,
+) -> Optional[np.ndarray]:
+    """Finds the screen (or screen region) corners in the camera frame.
+
+    Returns them clockwise, starting from the top left one. The result is
+    saved per camera, resolution and region, and reused as long as it still
+    matches what the camera sees.
+    """
     img = cam.read()
     h, w, _ = img.shape
+    reference = _diff_thumbnail(img)
 
     cnvs = np.zeros(img.shape, np.uint8)
 
-    cv2.rectangle(cnvs, (0, 0), (w, h), SQUARE_COLOR, cv2.FILLED)
-
-    corners = None
-    for _ in range(5):
-        show_image_fullscreen(cnvs)
-
-        cv2.waitKey(1000)
+    left, top, right, bottom = region or (0, 0, 1, 1)
+    cv2.rectangle(
+        cnvs,
+        (int(left * w), int(top * h)),
+        (int(right * w), int(bottom * h)),
+        SQUARE_COLOR,
+        cv2.FILLED,
+    )
 
-        img = cam.read()
+    show_image_fullscreen(cnvs)
+    img = wait_for_stable_frame(cam, reference)
+    key = calibration_key(cam, img)
+    if region:
+        key += "@" + ",".join(f"{edge:g}" for edge in region)
+
+    if not recalibrate:
+        saved_quad = load_calibration(key, calibration_path)
+        if saved_quad is not None and validate_screen_quad(
+            filter_cyan(img), saved_quad
+        ):
+            return saved_quad
+
+    quad = None
+    for _ in range(CALIBRATION_ATTEMPTS):
         filtered = filter_cyan(img)
 
-        corners = find_corners(filtered)
-        cv2.waitKey(1000)
+        quad = find_screen_quad(filtered, debug)
 
-        if corners:
+        if quad is not None:
             break
+
+        show_image_fullscreen(cnvs)
+        img = wait_for_stable_frame(cam)
     else:
         print("Failed to find screen corners!")
         return None
 
-    # print ("Corners are at: ", corners)
+    # print ("Corners are at: ", quad)
 
-    return Rectangle(*corners)
+    save_calibration(key, quad, calibration_path)
+    return quad
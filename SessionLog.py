@@ -0,0 +1,111 @@
+import mmap
+import time
+import struct
+import numpy as np
+from typing import Tuple
+from MappedFile import MappedFileWriter
+
+
+# Session log layout: a file header, followed by fixed size records. Records
+# are never rewritten, so a log can be read back as one array without parsing.
+LOG_MAGIC = b"VGLOG001"
+# Canvas height, width, undo history size
+FILE_HEADER = struct.Struct("<8sIII4x")
+# The file is grown (and remapped) in chunks of this size while logging
+LOG_CHUNK_BYTES = 1024 * 1024
+
+# Record kinds. Zero is left out, so unused (zeroed) space is never a record.
+EVENT_SEGMENT = 1
+# All pens are up, i.e. the end of what a single undo removes
+EVENT_STROKE_END = 2
+EVENT_CLEAR = 3
+EVENT_COLOR = 4
+EVENT_UNDO = 5
+EVENT_REDO = 6
+# The strokes since the last stroke end were dropped
+EVENT_DISCARD = 7
+
+# Seconds since the log was started, kind, BGR color, radius, and the segment's
+# two end points (x, y)
+RECORD_DTYPE = np.dtype(
+    [
+        ("time", "<f4"),
+        ("kind", "u1"),
+        ("color", "u1", (3,)),
+        ("radius", "u1"),
+        ("pad", "u1"),
+        ("points", "<i2", (2, 2)),
+    ]
+)
+
+
+class SessionLogWriter:
+    """Appends everything that is drawn to a session log, so that it can be
+    rendered later (see RenderSession.py)."""
+
+    def __init__(
+        self,
+        path: str,
+        canvas_size: Tuple[int, int],
+        history_size: int,
+        chunk_bytes: int = LOG_CHUNK_BYTES,
+    ):
+        self.path = path
+        self.out = MappedFileWriter(path, chunk_bytes)
+        mm, offset = self.out.append(FILE_HEADER.size)
+        FILE_HEADER.pack_into(
+            mm, offset, LOG_MAGIC, canvas_size[0], canvas_size[1], history_size
+        )
+        self.start = time.perf_counter()
+
+    def _append(self, cnt: int, kind: int, color: Tuple[int, int, int], radius: int):
+        mm, offset = self.out.append(cnt * RECORD_DTYPE.itemsize)
+        records = np.ndarray(cnt, RECORD_DTYPE, buffer=mm, offset=offset)
+        records["time"] = time.perf_counter() - self.start
+        records["kind"] = kind
+        records["color"] = color
+        records["radius"] = min(radius, 255)
+        return records
+
+    def segments(self, polyline: np.ndarray, color: Tuple[int, int, int], radius: int):
+        """Logs every segment of an (N, 2) polyline."""
+        if len(polyline) < 2:
+            return
+        records = self._append(len(polyline) - 1, EVENT_SEGMENT, color, radius)
+        records["points"][:, 0] = polyline[:-1]
+        records["points"][:, 1] = polyline[1:]
+        # Views must be gone before the file is remapped
+        del records
+
+    def event(self, kind: int, color: Tuple[int, int, int] = (0, 0, 0)):
+        records = self._append(1, kind, color, 0)
+        del records
+
+    def close(self):
+        self.out.close()
+
+
+class SessionLogReader:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, h, w, history_size = FILE_HEADER.unpack_from(self.mm, 0)
+        if magic != LOG_MAGIC:
+            raise ValueError(f"{path} is not a session log")
+        self.canvas_size = (h, w)
+        self.history_size = history_size
+
+        cnt = (len(self.mm) - FILE_HEADER.size) // RECORD_DTYPE.itemsize
+        records = np.ndarray(cnt, RECORD_DTYPE, buffer=self.mm, offset=FILE_HEADER.size)
+        # Unused space, e.g. when the game crashed before the file was truncated
+        unused = np.flatnonzero(records["kind"] == 0)
+        self.records = records[: unused[0]] if len(unused) else records
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def close(self):
+        self.records = None
+        self.mm.close()
+        self.file.close()
@@ -0,0 +1,70 @@
+import numpy as np
+from typing import Tuple, Optional
+from multiprocessing.shared_memory import SharedMemory
+
+
+# Everything a worker process needs to attach to an existing ring
+FrameRingSpec = Tuple[str, Tuple[int, ...], int]
+
+
+class SharedFrameRing:
+    """A ring of frame slots in shared memory.
+
+    The owner copies frames into slots, workers attach by name and read them
+    in place, so only (slot, seq) has to be sent to them.
+    """
+
+    def __init__(
+        self, frame_shape: Tuple[int, ...], slots: int, name: Optional[str] = None
+    ):
+        self.frame_shape = tuple(frame_shape)
+        self.slots = slots
+        self.owner = name is None
+
+        frame_bytes = int(np.prod(self.frame_shape))
+        seqs_offset = slots * frame_bytes
+        self.shm = SharedMemory(
+            name=name,
+            create=self.owner,
+            size=seqs_offset + slots * np.dtype(np.int64).itemsize,
+        )
+        self.frames = np.ndarray(
+            (slots,) + self.frame_shape, np.uint8, buffer=self.shm.buf
+        )
+        # The sequence number of the frame currently held by each slot
+        self.seqs = np.ndarray(
+            (slots,), np.int64, buffer=self.shm.buf, offset=seqs_offset
+        )
+        if self.owner:
+            self.seqs[:] = -1
+        self.next_seq = 0
+
+    @classmethod
+    def attach(cls, spec: FrameRingSpec) -> "SharedFrameRing":
+        name, frame_shape, slots = spec
+        return cls(frame_shape, slots, name=name)
+
+    def spec(self) -> FrameRingSpec:
+        return self.shm.name, self.frame_shape, self.slots
+
+    def write(self, frame) -> Tuple[int, int]:
+        seq = self.next_seq
+        slot = seq % self.slots
+        np.copyto(self.frames[slot], frame)
+        self.seqs[slot] = seq
+        self.next_seq += 1
+        return slot, seq
+
+    def read(self, slot: int, seq: int):
+        if self.seqs[slot] != seq:
+            # This slot was already overwritten by a newer frame
+            return None
+        return self.frames[slot]
+
+    def close(self):
+        # Drop our views first, otherwise the buffer can't be released
+        del self.frames
+        del self.seqs
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
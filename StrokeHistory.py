@@ -0,0 +1,112 @@
+import numpy as np
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+from Shapes import Rectangle
+from TiledCanvas import TiledCanvas, TileSnapshot
+
+
+# How many strokes can be undone
+MAX_HISTORY = 20
+
+
+class Stroke:
+    """A continuous polyline, with the color and radius it was drawn with."""
+
+    def __init__(self, color: Tuple[int, int, int], radius: int):
+        self.color = color
+        self.radius = radius
+        self._points = np.empty((16, 2), np.int32)
+        self.count = 0
+
+    @property
+    def points(self) -> np.ndarray:
+        return self._points[: self.count]
+
+    def extend(self, points: np.ndarray):
+        needed = self.count + len(points)
+        if needed > len(self._points):
+            grown = np.empty((max(needed, 2 * len(self._points)), 2), np.int32)
+            grown[: self.count] = self.points
+            self._points = grown
+        self._points[self.count : needed] = points
+        self.count = needed
+
+
+class HistoryEntry:
+    """The strokes drawn from putting a pen down until all pens are up, and
+    the tiles they changed as they were before (or after, for redo)."""
+
+    def __init__(self, strokes: List[Stroke], tiles: TileSnapshot):
+        self.strokes = strokes
+        self.tiles = tiles
+
+
+class StrokeHistory:
+    """Undo and redo of whole strokes, by swapping canvas tiles.
+
+    Only the tiles a stroke changed are kept, and only for the last
+    max_entries strokes.
+    """
+
+    def __init__(self, canvas: TiledCanvas, max_entries: int = MAX_HISTORY):
+        self.canvas = canvas
+        self.undo_entries: Deque[HistoryEntry] = deque(maxlen=max_entries)
+        self.redo_entries: Deque[HistoryEntry] = deque(maxlen=max_entries)
+        self.current: Optional[HistoryEntry] = None
+        # The undone strokes the current entry made unreachable, until it ends
+        self.replaced_redo_entries: Deque[HistoryEntry] = deque()
+
+    def begin(self) -> HistoryEntry:
+        """Called before drawing, starts recording a new entry if needed.
+        Returns the entry being recorded."""
+        if self.current is None:
+            self.current = HistoryEntry([], {})
+            self.canvas.start_recording()
+            # Drawing something new makes the undone strokes unreachable
+            self.replaced_redo_entries = self.redo_entries
+            self.redo_entries = deque(maxlen=self.redo_entries.maxlen)
+        return self.current
+
+    def new_stroke(self, color: Tuple[int, int, int], radius: int) -> Stroke:
+        stroke = Stroke(color, radius)
+        self.begin().strokes.append(stroke)
+        return stroke
+
+    def end(self):
+        """Called once all pens are up."""
+        if self.current is None:
+            return
+        self.current.tiles = self.canvas.stop_recording()
+        self.undo_entries.append(self.current)
+        self.current = None
+        self.replaced_redo_entries = deque()
+
+    def discard(self) -> List[Rectangle]:
+        """Drops the strokes drawn since the last end(), as if they were never
+        drawn. Returns the parts of the canvas they changed."""
+        if self.current is None:
+            return []
+        tiles = self.canvas.stop_recording()
+        self.canvas.restore(tiles)
+        self.current = None
+        self.redo_entries = self.replaced_redo_entries
+        self.replaced_redo_entries = deque()
+        return [self.canvas.tile_rect(key) for key in tiles]
+
+    def _swap(
+        self, source: Deque[HistoryEntry], target: Deque[HistoryEntry]
+    ) -> List[Rectangle]:
+        self.end()
+        if not source:
+            return []
+        entry = source.pop()
+        replaced = self.canvas.restore(entry.tiles)
+        target.append(HistoryEntry(entry.strokes, replaced))
+        return [self.canvas.tile_rect(key) for key in entry.tiles]
+
+    def undo(self) -> List[Rectangle]:
+        """Undoes the last stroke, returns the parts of the canvas it changed."""
+        return self._swap(self.undo_entries, self.redo_entries)
+
+    def redo(self) -> List[Rectangle]:
+        return self._swap(self.redo_entries, self.undo_entries)
@@ -0,0 +1,238 @@
+import cv2
+import numpy as np
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from Shapes import Point, Rectangle
+
+
+# Canvas pixels per tile side, a multiple of every scale we downscale by
+TILE_SIZE = 256
+
+TileKey = Tuple[int, int]
+# Tiles by key, None for ones that were not allocated
+TileSnapshot = Dict[TileKey, Optional[np.ndarray]]
+
+
+def _runs(tile_indices: np.ndarray) -> List[Tuple[int, int]]:
+    """Splits sorted (or reverse sorted) tile indices into runs of equal ones."""
+    edges = np.flatnonzero(np.diff(tile_indices)) + 1
+    bounds = [0] + edges.tolist() + [len(tile_indices)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class TiledCanvas:
+    """A canvas split into square tiles, which are only allocated once
+    something is drawn on them. Missing tiles are black.
+
+    Memory and clearing cost scale with what was drawn, not with the canvas
+    size. Tiles are copied on write once they are shared with a snapshot, so
+    snapshots only cost the tiles that changed since.
+    """
+
+    def __init__(self, shape: Tuple[int, ...], tile_size: int = TILE_SIZE):
+        self.shape = tuple(shape)
+        self.tile_size = tile_size
+        self.tiles: Dict[TileKey, np.ndarray] = {}
+        # Tiles that are also referenced by a snapshot
+        self.shared: Set[TileKey] = set()
+        # The tiles as they were before recording started, for the ones that
+        # were written to since
+        self.recording: Optional[TileSnapshot] = None
+
+    def clear(self):
+        self.tiles = {}
+        self.shared = set()
+
+    def nbytes(self) -> int:
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def snapshot(self) -> "TiledCanvas":
+        """The canvas as it is now. Nothing is copied, the tiles are shared
+        (by both canvases) until written to."""
+        snapshot = TiledCanvas(self.shape, self.tile_size)
+        snapshot.tiles = dict(self.tiles)
+        snapshot.shared = set(self.tiles)
+        self.shared.update(self.tiles)
+        return snapshot
+
+    def start_recording(self):
+        self.recording = {}
+
+    def stop_recording(self) -> TileSnapshot:
+        """The tiles written to since recording started, as they were then."""
+        recorded = self.recording or {}
+        self.recording = None
+        return recorded
+
+    def restore(self, snapshot: TileSnapshot) -> TileSnapshot:
+        """Puts back the tiles of a snapshot, returns the ones they replaced.
+
+        Nothing is copied, the tiles are shared until written to.
+        """
+        replaced = {}
+        for key, tile in snapshot.items():
+            replaced[key] = self.tiles.pop(key, None)
+            if tile is not None:
+                self.tiles[key] = tile
+            self.shared.add(key)
+        return replaced
+
+    def tile_keys(self, left: int, top: int, right: int, bottom: int) -> List[TileKey]:
+        """The (row, col) keys of all tiles that overlap the given area."""
+        h, w = self.shape[:2]
+        left, top = max(0, int(left)), max(0, int(top))
+        right, bottom = min(w, int(right)), min(h, int(bottom))
+        if left >= right or top >= bottom:
+            return []
+        t = self.tile_size
+        return [
+            (ty, tx)
+            for ty in range(top // t, (bottom - 1) // t + 1)
+            for tx in range(left // t, (right - 1) // t + 1)
+        ]
+
+    def tile_rect(self, key: TileKey) -> Rectangle:
+        ty, tx = key
+        t = self.tile_size
+        h, w = self.shape[:2]
+        return Rectangle(
+            Point(tx * t, ty * t), Point(min(w, (tx + 1) * t), min(h, (ty + 1) * t))
+        )
+
+    def tile(self, key: TileKey) -> np.ndarray:
+        """The tile for key, to be written to. Allocated if it wasn't yet."""
+        tile = self.tiles.get(key)
+        if self.recording is not None and key not in self.recording:
+            self.recording[key] = tile
+            self.shared.add(key)
+        if key in self.shared:
+            self.shared.discard(key)
+            if tile is not None:
+                tile = tile.copy()
+                self.tiles[key] = tile
+        if tile is None:
+            ty, tx = key
+            t = self.tile_size
+            h, w = self.shape[:2]
+            # Tiles on the right and bottom edges are cut at the canvas edge
+            tile = np.zeros(
+                (min(t, h - ty * t), min(t, w - tx * t)) + self.shape[2:], np.uint8
+            )
+            self.tiles[key] = tile
+        return tile
+
+    def polylines(
+        self,
+        strokes: List[np.ndarray],
+        color,
+        thickness: int,
+        line_type: int = cv2.LINE_AA,
+    ):
+        """Like cv2.polylines, but only touches the tiles around the strokes."""
+        # Anti-aliasing reaches a bit further than half the thickness
+        margin = thickness // 2 + 2
+        points = np.concatenate(strokes)
+        h, w = self.shape[:2]
+        left, top = np.maximum(points.min(axis=0) - margin, 0)
+        right, bottom = np.minimum(points.max(axis=0) + margin + 1, (w, h))
+        if left >= right or top >= bottom:
+            return
+
+        # Lines are drawn on a copy of the area around them rather than on each
+        # tile, since OpenCV would clip them at every tile edge, which moves
+        # their pixels a bit
+        area = self[top:bottom, left:right]
+        offset = np.int32([left, top])
+        cv2.polylines(
+            area,
+            [stroke - offset for stroke in strokes],
+            False,
+            color,
+            thickness=thickness,
+            lineType=line_type,
+        )
+        for key, tile_part, area_part in self._overlaps(top, bottom, left, right):
+            part = area[area_part]
+            # Tiles the lines only passed near stay unallocated
+            if key in self.tiles or part.any():
+                self.tile(key)[tile_part] = part
+
+    def _overlaps(
+        self, top: int, bottom: int, left: int, right: int
+    ) -> Iterator[Tuple[TileKey, Tuple[slice, slice], Tuple[slice, slice]]]:
+        """For every tile overlapping the area, yields its key, the overlapping
+        part of the tile, and the same part of the area."""
+        t = self.tile_size
+        for ty, tx in self.tile_keys(left, top, right, bottom):
+            y0, x0 = ty * t, tx * t
+            oy0, oy1 = max(top, y0), min(bottom, y0 + t)
+            ox0, ox1 = max(left, x0), min(right, x0 + t)
+            yield (ty, tx), (slice(oy0 - y0, oy1 - y0), slice(ox0 - x0, ox1 - x0)), (
+                slice(oy0 - top, oy1 - top),
+                slice(ox0 - left, ox1 - left),
+            )
+
+    def _area(self, index: Tuple[slice, slice]) -> Tuple[int, int, int, int]:
+        rows, cols = index
+        top, bottom, _ = rows.indices(self.shape[0])
+        left, right, _ = cols.indices(self.shape[1])
+        return top, max(top, bottom), left, max(left, right)
+
+    def __getitem__(self, index: Tuple[slice, slice]) -> np.ndarray:
+        """A dense copy of a rectangular area, e.g. canvas[y0:y1, x0:x1]."""
+        top, bottom, left, right = self._area(index)
+        out = np.zeros((bottom - top, right - left) + self.shape[2:], np.uint8)
+        for key, tile_part, out_part in self._overlaps(top, bottom, left, right):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                out[out_part] = tile[tile_part]
+        return out
+
+    def __setitem__(self, index: Tuple[slice, slice], value):
+        top, bottom, left, right = self._area(index)
+        value = np.broadcast_to(value, (bottom - top, right - left) + self.shape[2:])
+        for key, tile_part, value_part in self._overlaps(top, bottom, left, right):
+            self.tile(key)[tile_part] = value[value_part]
+
+    def to_array(self) -> np.ndarray:
+        return self[:, :]
+
+    def sample(self, rows: np.ndarray, cols: np.ndarray, out: np.ndarray):
+        """out[:] = canvas[rows[:, None], cols], reading the tiles directly.
+
+        rows must be sorted, cols sorted or reverse sorted (when mirrored).
+        """
+        t = self.tile_size
+        row_tiles = rows // t
+        col_tiles = cols // t
+        col_runs = _runs(col_tiles)
+        for r0, r1 in _runs(row_tiles):
+            ty = int(row_tiles[r0])
+            tile_rows = rows[r0:r1, None] - ty * t
+            for c0, c1 in col_runs:
+                tx = int(col_tiles[c0])
+                tile = self.tiles.get((ty, tx))
+                if tile is None:
+                    out[r0:r1, c0:c1] = 0
+                else:
+                    out[r0:r1, c0:c1] = tile[tile_rows, cols[c0:c1] - tx * t]
+
+    def downscaled_plane(
+        self, plane: Callable[[np.ndarray], np.ndarray], scale: int
+    ) -> np.ndarray:
+        """A single channel image made from the canvas by plane (which must
+        keep black at 0), shrunk by scale with area averaging."""
+        h, w = self.shape[:2]
+        out = np.zeros((h // scale, w // scale), np.uint8)
+        t = self.tile_size
+        for (ty, tx), tile in self.tiles.items():
+            y0, x0 = ty * t // scale, tx * t // scale
+            sh = min(tile.shape[0] // scale, out.shape[0] - y0)
+            sw = min(tile.shape[1] // scale, out.shape[1] - x0)
+            if sh <= 0 or sw <= 0:
+                continue
+            out[y0 : y0 + sh, x0 : x0 + sw] = cv2.resize(
+                plane(tile[: sh * scale, : sw * scale]),
+                (sw, sh),
+                interpolation=cv2.INTER_AREA,
+            )
+        return out
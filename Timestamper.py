@@ -1,23 +1,26 @@
 import time
-
-EPSILON_SEC = 1 / 1000.0
+from typing import Dict, Optional
+from Metrics import Metrics, LatencyHistogram, gMetrics
 
 
 class Timestamper:
-    def __init__(self, printing_enabled=True):
-        self.printing_enabled = printing_enabled
-        self.last_timestamp = time.time()
+    """Records how long each section took into the calling thread's
+    histograms. Never prints, so it can stay on all the time."""
+
+    def __init__(self, metrics: Optional[Metrics] = None):
+        self.metrics = metrics or gMetrics
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.last_timestamp = time.perf_counter_ns()
         self.last_section_name = ""
 
-    def stamp_start(self, new_section_name: str, skip_print: bool = False):
-        time_delta = time.time() - self.last_timestamp
-        if (
-            self.printing_enabled
-            and not skip_print
-            and self.last_section_name
-            and time_delta > EPSILON_SEC
-        ):
-            print(f"{self.last_section_name} - {time_delta*1000:.1f}ms")
+    def stamp_start(self, new_section_name: str):
+        now = time.perf_counter_ns()
+        if self.last_section_name:
+            histogram = self.histograms.get(self.last_section_name)
+            if histogram is None:
+                histogram = self.metrics.histogram(self.last_section_name)
+                self.histograms[self.last_section_name] = histogram
+            histogram.record(now - self.last_timestamp)
 
-        self.last_timestamp = time.time()
+        self.last_timestamp = now
         self.last_section_name = new_section_name
@@ -0,0 +1,81 @@
+import numpy as np
+from typing import List, Optional, Set, Tuple
+from Buttons import Button
+from Shapes import Point, Rectangle
+
+
+# The label map is kept at 1 / HIT_MAP_SCALE of the canvas resolution
+HIT_MAP_SCALE = 4
+# Labels are uint8, and 0 means no widget
+MAX_WIDGETS = 255
+
+
+class WidgetLayer:
+    """On-screen controls, kept apart from the canvas and composited on top of
+    it when displayed.
+
+    A label map holds the (1 based) index of the widget at every spot, so hit
+    testing takes the same time however many widgets there are.
+    """
+
+    def __init__(self, canvas_size: Tuple[int, int], scale: int = HIT_MAP_SCALE):
+        h, w = canvas_size
+        self.scale = scale
+        self.labels = np.zeros((-(-h // scale), -(-w // scale)), np.uint8)
+        self.widgets: List[Button] = []
+        # Widgets that were pressed on the last tick
+        self.held: Set[Button] = set()
+        # Widgets that look different since they were last shown
+        self.changed: List[Button] = []
+
+    def add(self, widget: Button):
+        if len(self.widgets) >= MAX_WIDGETS:
+            raise ValueError(f"No more than {MAX_WIDGETS} widgets are supported")
+        self.widgets.append(widget)
+        # Every cell the widget touches, hits are then checked exactly
+        r = widget.position
+        self.labels[
+            max(0, r.bottom_y()) // self.scale : -(-r.top_y() // self.scale),
+            max(0, r.left_x()) // self.scale : -(-r.right_x() // self.scale),
+        ] = len(self.widgets)
+
+    def hit(self, pos: Optional[Point]) -> Optional[Button]:
+        if pos is None:
+            return None
+        y, x = pos.y // self.scale, pos.x // self.scale
+        if not (0 <= y < self.labels.shape[0] and 0 <= x < self.labels.shape[1]):
+            return None
+        label = self.labels[y, x]
+        if not label:
+            return None
+        widget = self.widgets[label - 1]
+        return widget if widget.is_pressed(pos) else None
+
+    def widgets_in(self, rect: Rectangle) -> List[Button]:
+        """The widgets that may overlap the given part of the canvas."""
+        s = self.scale
+        labels = np.unique(
+            self.labels[
+                max(0, rect.bottom_y()) // s : -(-rect.top_y() // s),
+                max(0, rect.left_x()) // s : -(-rect.right_x() // s),
+            ]
+        )
+        return [self.widgets[label - 1] for label in labels if label]
+
+    def press(self, positions: List[Point]) -> Optional[Button]:
+        """Presses the widgets under the given positions, and releases the ones
+        that are no longer pointed at. Returns the last one that fired."""
+        pressed = {widget for widget in map(self.hit, positions) if widget}
+        fired = None
+        for widget in pressed | self.held:
+            was_held = widget.held
+            if widget.press(widget in pressed):
+                fired = widget
+            if widget.held != was_held:
+                self.changed.append(widget)
+        self.held = pressed
+        return fired
+
+    def pop_changed(self) -> List[Button]:
+        changed, self.changed = self.changed, []
+        return changed